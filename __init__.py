@@ -1,4 +1,4 @@
-from .tokenizer import tokens
+from .tokenizer import tokens, Analyzer
 from .search import SearchEngine
 from .evaluator import Evaluator
 
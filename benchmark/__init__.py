@@ -0,0 +1,2 @@
+from .corpus import generate_corpus
+from .run import CONFIGS, run_benchmarks, check_regressions
@@ -0,0 +1,113 @@
+import os
+import json
+
+import numpy as np
+
+# most frequent words of english text, the head of every vocabulary so
+# that docs look english to the english_only check
+COMMON_WORDS = ['the', 'of', 'and', 'to', 'a', 'in', 'is', 'it', 'that',
+                'for', 'i', 'was', 'on', 'with', 'as', 'you', 'be', 'this',
+                'have', 'are', 'at', 'but', 'not', 'by', 'from', 'he', 'or',
+                'they', 'we', 'an', 'my', 'all', 'so', 'his', 'there', 'what',
+                'about', 'if', 'more', 'when', 'will', 'can', 'one', 'out',
+                'just', 'would', 'she', 'up', 'their', 'has']
+
+ONSETS = ['b', 'c', 'd', 'f', 'g', 'h', 'j', 'k', 'l', 'm', 'n', 'p', 'r',
+          's', 't', 'v', 'w', 'z', 'br', 'ch', 'cl', 'dr', 'gr', 'pl', 'sh',
+          'st', 'th', 'tr']
+VOWELS = ['a', 'e', 'i', 'o', 'u', 'ai', 'ea', 'io', 'ou']
+CODAS = ['', '', 'n', 'r', 's', 't', 'l', 'ng', 'st', 'ck']
+
+MANIFEST = 'manifest.json'
+
+
+def make_word(random_state, syllables):
+    """A pronounceable made up word, letters only."""
+    return ''.join(random_state.choice(ONSETS) + random_state.choice(VOWELS) +
+                   random_state.choice(CODAS) for i in range(syllables))
+
+
+def vocabulary(random_state, size, extra_words=()):
+    """size distinct words by frequency rank, common english words first.
+
+    extra_words, such as the topic title words, are spread over the ranks
+    after the common words so queries match docs.
+    """
+    words = list(COMMON_WORDS)
+    seen = set(words)
+    extra_words = [word for word in extra_words if word not in seen]
+    seen.update(extra_words)
+    while len(words) + len(extra_words) < size:
+        word = make_word(random_state, random_state.randint(1, 4))
+        if word not in seen:
+            seen.add(word)
+            words.append(word)
+    ranks = random_state.randint(len(COMMON_WORDS), len(words) + 1,
+                                 len(extra_words))
+    for rank, word in sorted(zip(ranks, extra_words), reverse=True):
+        words.insert(rank, word)
+    return words[:max(size, len(COMMON_WORDS) + len(extra_words))]
+
+
+def zipf_probabilities(size, exponent):
+    weights = 1.0 / np.arange(1, size + 1) ** exponent
+    return weights / weights.sum()
+
+
+def generate_corpus(out_dir, num_docs=2000, vocab_size=20000,
+                    median_length=250, length_sigma=1.0, exponent=1.1,
+                    non_english=0.05, blank=0.01, extra_words=(), seed=0):
+    """Write a synthetic blog corpus, one file per doc under out_dir/docs.
+
+    Words follow a Zipf distribution over the vocabulary and doc lengths
+    are log-normal around median_length, like blog posts. A fraction of
+    docs skip the common english words, for english_only, and a fraction
+    are blank. The same arguments always write the same corpus, and a
+    corpus already written with them is reused. Returns the docs directory.
+    """
+    params = {'num_docs': num_docs, 'vocab_size': vocab_size,
+              'median_length': median_length, 'length_sigma': length_sigma,
+              'exponent': exponent, 'non_english': non_english,
+              'blank': blank, 'extra_words': sorted(set(extra_words)),
+              'seed': seed}
+    docs_dir = os.path.join(out_dir, 'docs')
+    manifest = os.path.join(out_dir, MANIFEST)
+    if os.path.exists(manifest):
+        with open(manifest) as f:
+            if json.load(f) == params:
+                return docs_dir
+        raise Exception('Error: {} holds a different corpus.'.format(out_dir))
+    if not os.path.isdir(docs_dir):
+        os.makedirs(docs_dir)
+
+    random_state = np.random.RandomState(seed)
+    words = np.array(vocabulary(random_state, vocab_size,
+                                params['extra_words']))
+    probabilities = zipf_probabilities(len(words), exponent)
+    # the same distribution without the common words
+    foreign = probabilities.copy()
+    foreign[:len(COMMON_WORDS)] = 0
+    foreign /= foreign.sum()
+
+    lengths = np.minimum(random_state.lognormal(
+        np.log(median_length), length_sigma, num_docs).astype(int) + 1,
+        50 * median_length)
+    for doc in range(num_docs):
+        draw = random_state.random_sample(2)
+        if draw[0] < blank:
+            text = ''
+        else:
+            p = foreign if draw[1] < non_english else probabilities
+            ids = random_state.choice(len(words), lengths[doc], p=p)
+            # break the text into lines of about a dozen words
+            lines = [' '.join(words[ids[first:first + 12]])
+                     for first in range(0, len(ids), 12)]
+            text = '\n'.join(lines) + '\n'
+        name = 'BLOG06-20060201-000-{:010d}.txt'.format(doc)
+        with open(os.path.join(docs_dir, name), 'w') as f:
+            f.write(text)
+
+    # written last, so an interrupted run is not reused
+    with open(manifest, 'w') as f:
+        json.dump(params, f)
+    return docs_dir
@@ -0,0 +1,224 @@
+"""Benchmark index builds and queries over a synthetic corpus.
+
+python -m benchmark.run --out bench.json
+python -m benchmark.run --compare bench.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import resource
+import tempfile
+from itertools import product
+from multiprocessing import Pool
+
+import nltk
+import numpy as np
+
+from search import SearchEngine
+from judgments import Judgments, QRELS, TOPICS
+from tokenizer import tokens
+from sources import DirectorySource
+from benchmark.corpus import generate_corpus
+
+# option combinations benchmarked by default
+CONFIGS = {
+    'default': {},
+    'normalize': {'normalize': True},
+    'biwords': {'biwords': True},
+    'english_only': {'english_only': True},
+    'porter': {'stemming': 'porter'},
+    'lemmatize': {'lemmatize': True},
+    'normalize_biwords_porter': {'normalize': True, 'biwords': True,
+                                 'stemming': 'porter'}
+}
+
+# metrics where smaller is better, and where larger is
+LOWER_IS_BETTER = ['build_seconds', 'tokenize_seconds', 'rss_growth_mb',
+                   'index_bytes', 'p50_ms', 'p95_ms', 'p99_ms']
+HIGHER_IS_BETTER = ['queries_per_second', 'batch_queries_per_second']
+
+
+def all_configs():
+    """Every combination of the options, stemming and lemmatize apart."""
+    configs = {}
+    for normalize, biwords, english_only, stem in product(
+            [False, True], [False, True], [False, True],
+            [None, 'porter', 'lemmatize']):
+        options = {'normalize': normalize, 'biwords': biwords,
+                   'english_only': english_only}
+        if stem == 'lemmatize':
+            options['lemmatize'] = True
+        elif stem:
+            options['stemming'] = stem
+        name = '_'.join(key for key in ['normalize', 'biwords',
+                                        'english_only'] if options[key])
+        configs['_'.join(filter(None, [name, stem])) or 'default'] = options
+    return configs
+
+
+def peak_rss_mb():
+    # linux reports kilobytes, including finished build workers
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024.0
+
+
+def _run_config(args):
+    # runs in a fresh process, which starts out with the RSS of the process
+    # it was forked from, so only its growth is the config's own
+    options, corpus_dir, num_docs, queries, repeat, k, workers = args
+    random.seed(0)
+    start_rss = peak_rss_mb()
+    start = time.time()
+    start_cpu = time.clock()
+    engine = SearchEngine(sample=True, docs=num_docs, corpus_dir=corpus_dir,
+                          workers=workers, **options)
+    result = {'build_seconds': time.time() - start,
+              'build_cpu_seconds': time.clock() - start_cpu,
+              'rss_growth_mb': peak_rss_mb() - start_rss,
+              'terms': len(engine.index)}
+
+    handle, path = tempfile.mkstemp(suffix='.idx')
+    os.close(handle)
+    try:
+        engine.save(path)
+        result['index_bytes'] = os.path.getsize(path)
+    finally:
+        os.remove(path)
+
+    # tokenizing and counting alone, as the build does for every doc
+    source = DirectorySource(corpus_dir)
+    docs = [doc for part in source.parts() for (blog_id, doc)
+            in source.read(part) if doc]
+    start = time.time()
+    for i in range(repeat):
+        for doc in docs:
+            dict(nltk.FreqDist(engine.analyzer.iter_tokens(doc)))
+    result['tokenize_seconds'] = (time.time() - start) / repeat
+
+    # one query at a time, as a user would
+    latencies = list()
+    for i in range(repeat):
+        for query in queries:
+            start = time.time()
+            engine.query(query, k)
+            latencies.append(time.time() - start)
+    latencies = np.array(latencies)
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1000
+    result.update({'p50_ms': p50, 'p95_ms': p95, 'p99_ms': p99,
+                   'queries_per_second': len(latencies) / latencies.sum()})
+
+    start = time.time()
+    for i in range(repeat):
+        engine.query_batch(queries, k)
+    result['batch_queries_per_second'] = (repeat * len(queries) /
+                                          (time.time() - start))
+    return result
+
+
+def run_benchmarks(configs, corpus_dir, num_docs, queries, repeat=5, k=10,
+                   workers=1):
+    """Build and query an engine per named option set, in separate processes.
+
+    A config that fails, e.g. for missing nltk data, gets an error entry.
+    """
+    results = {}
+    for name in sorted(configs):
+        pool = Pool(1)
+        try:
+            results[name] = pool.apply(_run_config, [(
+                configs[name], corpus_dir, num_docs, queries, repeat, k,
+                workers)])
+        except Exception as error:
+            results[name] = {'error': '{}: {}'.format(
+                type(error).__name__, error)}
+        finally:
+            pool.close()
+            pool.join()
+        print >> sys.stderr, name, results[name]
+    return results
+
+
+def check_regressions(baseline, current, tolerance=0.1):
+    """Metrics of current more than tolerance worse than in baseline."""
+    regressions = list()
+    for name in sorted(set(baseline) & set(current)):
+        old, new = baseline[name], current[name]
+        for metric in LOWER_IS_BETTER + HIGHER_IS_BETTER:
+            if metric not in old or metric not in new:
+                continue
+            if metric in LOWER_IS_BETTER:
+                worse = new[metric] > old[metric] * (1 + tolerance)
+            else:
+                worse = new[metric] * (1 + tolerance) < old[metric]
+            if worse:
+                regressions.append('{} {}: {:.4g} -> {:.4g}'.format(
+                    name, metric, old[metric], new[metric]))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--docs', type=int, default=2000)
+    parser.add_argument('--vocab', type=int, default=20000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--corpus-dir', help='where the corpus is written, '
+                        'reused across runs (default: a temp directory)')
+    parser.add_argument('--configs', nargs='+', help='names from CONFIGS')
+    parser.add_argument('--all', action='store_true',
+                        help='every combination of options')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('-k', type=int, default=10)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--topics', default=TOPICS)
+    parser.add_argument('--out', help='write results as JSON')
+    parser.add_argument('--compare', help='JSON of an earlier run, exits '
+                        'with status 1 on any regression')
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    args = parser.parse_args(argv)
+
+    configs = all_configs() if args.all else CONFIGS
+    if args.configs:
+        configs = dict((name, configs[name]) for name in args.configs)
+
+    queries = Judgments.load(QRELS, args.topics).queries().values()
+    title_words = set(word for query in queries for word in tokens(query))
+    corpus_dir = args.corpus_dir or os.path.join(
+        tempfile.gettempdir(), 'searchengine-benchmark-{}-{}-{}'.format(
+            args.docs, args.vocab, args.seed))
+    docs_dir = generate_corpus(corpus_dir, args.docs, args.vocab,
+                               extra_words=title_words, seed=args.seed)
+
+    report = {
+        'meta': {'docs': args.docs, 'vocab': args.vocab, 'seed': args.seed,
+                 'queries': len(queries), 'repeat': args.repeat, 'k': args.k,
+                 'workers': args.workers, 'time': time.time(),
+                 'python': platform.python_version(),
+                 'platform': platform.platform(),
+                 'numpy': np.__version__},
+        'results': run_benchmarks(configs, docs_dir + '/', args.docs,
+                                  sorted(queries), args.repeat, args.k,
+                                  args.workers)
+    }
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        print json.dumps(report, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = check_regressions(baseline['results'],
+                                        report['results'], args.tolerance)
+        for regression in regressions:
+            print >> sys.stderr, 'REGRESSION', regression
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,146 @@
+class LRUCache(object):
+    """Bounded mapping that evicts the least recently used entry.
+
+    Entries sit in a circular doubly linked list of [prev, next, key, value]
+    links, most recent just after the root, so hits and evictions are a few
+    list assignments.
+    """
+
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.clear()
+
+    def clear(self):
+        self.links = {}
+        self.root = []
+        self.root[:] = [self.root, self.root, None, None]
+
+    def __len__(self):
+        return len(self.links)
+
+    def __contains__(self, key):
+        return key in self.links
+
+    def get(self, key, default=None):
+        link = self.links.get(key)
+        if link is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self._touch(link)
+        return link[3]
+
+    def put(self, key, value):
+        """Store value, returning the (key, value) evicted for it if any."""
+        link = self.links.get(key)
+        if link is not None:
+            link[3] = value
+            self._touch(link)
+            return
+        if self.maxsize <= 0:
+            return
+        evicted = None
+        if len(self.links) >= self.maxsize:
+            # drop the least recent, at the back
+            evicted = self.pop_oldest()
+            self.evictions += 1
+        root = self.root
+        first = root[1]
+        link = [root, first, key, value]
+        first[0] = link
+        root[1] = link
+        self.links[key] = link
+        return evicted
+
+    def _touch(self, link):
+        # move to the front
+        prev, nxt = link[0], link[1]
+        prev[1] = nxt
+        nxt[0] = prev
+        root = self.root
+        first = root[1]
+        link[0] = root
+        link[1] = first
+        first[0] = link
+        root[1] = link
+
+    def pop_oldest(self):
+        """Remove and return the least recent (key, value)."""
+        last = self.root[0]
+        if last is self.root:
+            raise KeyError('cache is empty')
+        self.pop(last[2])
+        return last[2], last[3]
+
+    def pop(self, key, default=None):
+        link = self.links.pop(key, None)
+        if link is None:
+            return default
+        link[0][1] = link[1]
+        link[1][0] = link[0]
+        return link[3]
+
+
+class ResultCache(object):
+    """Ranked results keyed on analyzed query terms, with LRU eviction.
+
+    An entry holds the top k (score, doc) pairs of a query and answers any
+    later request for k or fewer. Bounded by entries and optionally by an
+    estimate of the bytes held.
+    """
+
+    # rough bytes per entry and per cached result
+    ENTRY_BYTES = 200
+    RESULT_BYTES = 80
+
+    def __init__(self, maxsize=1000, max_bytes=None):
+        self.entries = LRUCache(maxsize)
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.memory_evictions = 0
+
+    @property
+    def evictions(self):
+        return self.entries.evictions + self.memory_evictions
+
+    def size(self, entry):
+        return self.ENTRY_BYTES + self.RESULT_BYTES * len(entry[1])
+
+    def get(self, key, k):
+        """The top k for key, or None if no entry is deep enough."""
+        entry = self.entries.get(key)
+        # an entry shorter than its k holds every match there is
+        if entry is not None and (entry[0] >= k or len(entry[1]) < entry[0]):
+            self.hits += 1
+            return entry[1][:k]
+        self.misses += 1
+        return None
+
+    def put(self, key, k, top):
+        old = self.entries.pop(key)
+        if old is not None:
+            self.bytes -= self.size(old)
+        entry = (k, top)
+        evicted = self.entries.put(key, entry)
+        if evicted is not None:
+            self.bytes -= self.size(evicted[1])
+        if key in self.entries:
+            self.bytes += self.size(entry)
+        while self.max_bytes is not None and self.bytes > self.max_bytes:
+            oldest_key, oldest = self.entries.pop_oldest()
+            self.bytes -= self.size(oldest)
+            self.memory_evictions += 1
+
+    def clear(self):
+        self.entries.clear()
+        self.bytes = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'entries': len(self.entries),
+                'bytes': self.bytes}
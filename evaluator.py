@@ -1,24 +1,64 @@
-import re
+import time
 import random
 
+import numpy as np
 import pandas as pd
 
+from stats import Stats
+from judgments import Judgments
+
 
 class Evaluator(object):
     """Class to evalute a search engine against gold standard relevant docs."""
 
     def __init__(self, search_engine,
                  relevant_file='qrels.february',
-                 topic_file='06.topics.851-900.txt', num_docs=10):
-        """Initialize w/ search engine to evaluate."""
+                 topic_file='06.topics.851-900.txt', num_docs=10, stats=None,
+                 judgments=None):
+        """Initialize w/ search engine to evaluate.
+
+        judgments, a Judgments, is loaded from the two files (or their
+        cache) if not given. stats times the evaluation stages, enabled if
+        the engine's are.
+        """
         self.search_engine = search_engine
         self.num_docs = num_docs
+        if stats is None:
+            stats = Stats(search_engine.stats.enabled)
+        self.stats = stats
+
+        with self.stats.timer('judgments'):
+            if judgments is None:
+                judgments = Judgments.load(relevant_file, topic_file)
+            self.read_judgments(judgments)
+
+        # query_id: [list,of,retrieved,docs]
+        self.retrieved = {}
+        self.metrics = {}
+        self.results = None
+        self.averages = None
 
-        topics = open(topic_file).read()
-        queries = re.findall(r'<num> Number: (\d+)\n\n<title> '
-                             '([\"\w+\s+\d+\??]+)\s\s<desc>', topics)
-        self.query_dict = dict([(query[0].rstrip(), query[1])
-                                for query in queries])
+        # topics with relevant docs, the rows of the hit matrix
+        self.query_ids = sorted(query_id for query_id in self.query_dict
+                                if self.relevant.get(query_id))
+        self.num_relevant = np.array([len(self.relevant[query_id])
+                                      for query_id in self.query_ids],
+                                     dtype=np.float64)
+        self.hits = None
+        self.depth = 0
+
+        with self.stats.profile('evaluate'):
+            with self.stats.timer('retrieve'):
+                self.query_many()
+            with self.stats.timer('metrics'):
+                self.calc_metrics()
+        self.results = pd.DataFrame(self.metrics).T
+        self.averages = self.results.mean()
+
+    def read_judgments(self, judgments):
+        """Take the topics, and the relevant docs we have text for."""
+        self.judgments = judgments
+        self.query_dict = judgments.queries()
         self.query_dict_inv = dict([(val, key) for (key, val)
                                     in self.query_dict.items()])
 
@@ -27,123 +67,205 @@ class Evaluator(object):
         missing = missing.merge(self.search_engine.blog_ids,
                                 left_on='num',
                                 right_index=True)
-
-        # QRELS format:
-        # 851 0 BLOG06-20060201-000-0021156117 0
-        # query_id: [list,of,relevant,docs]
-        self.relevant = {}
-        for line in open(relevant_file):
-            data = line.split()
-            query_id = data[0]
-            blog_id = data[2]
-
-            # only look at blog id's that we actually have documents for!
-            if blog_id not in set(missing['id']):
-                if query_id not in self.relevant:
-                    self.relevant[query_id] = []
-                if int(data[3]) > 0:
-                    if blog_id in set(self.search_engine.blog_ids['id']):
-                        self.relevant[query_id].append(blog_id)
-
-        # query_id: [list,of,retrieved,docs]
-        self.retrieved = {}
-        self.metrics = {}
-        self.results = None
-        self.averages = None
         self.missing = missing
 
-        self.query_many()
-        self.calc_metrics()
-        self.results = pd.DataFrame(self.metrics).T
-        self.averages = self.results.mean()
+        # query_id: [list,of,relevant,docs]
+        # only look at blog id's that we actually have documents for!
+        blog_ids = self.search_engine.blog_ids['id']
+        self.relevant = dict(
+            (query_id, list(blog_ids.loc[docs]))
+            for (query_id, docs)
+            in judgments.relevant_docs(self.search_engine).items())
 
-    def query_many(self):
-        for query_id in self.query_dict.keys():
-            results = self.search_engine.query(self.query_dict[query_id],
-                                               self.num_docs)
+    def query_many(self, depth=None):
+        """Retrieve every topic once, to depth (at least num_docs)."""
+        depth = max(depth or 0, self.num_docs)
+        # score all topics in one batch
+        query_ids = self.query_dict.keys()
+        batch = self.search_engine.query_batch(
+            [self.query_dict[query_id] for query_id in query_ids], depth)
+        collection_ids = (set(self.search_engine.blog_ids['id']) -
+                          set(self.missing['id']))
+        for query_id, results in zip(query_ids, batch):
             self.retrieved[query_id] = list(results['id'])
             # some relevant docs may not be not returned
             # due to the terms being missing from the query
             query_results = self.retrieved[query_id]
             num_results = len(query_results)
-            if num_results < self.num_docs:
+            if num_results < depth:
                 # return a random sample of other collection files
-                other_ids = (set(self.search_engine.blog_ids['id']) -
-                             set(self.missing['id']) - set(query_results))
+                other_ids = collection_ids - set(query_results)
                 self.retrieved[query_id] += random.sample(
-                    other_ids, self.num_docs - num_results)
+                    other_ids, min(depth - num_results, len(other_ids)))
+
+        # hits[i, j]: is the doc at rank j + 1 for query_ids[i] relevant
+        self.depth = depth
+        self.hits = np.zeros((len(self.query_ids), depth), dtype=bool)
+        for i, query_id in enumerate(self.query_ids):
+            relevant = set(self.relevant[query_id])
+            retrieved = self.retrieved[query_id]
+            self.hits[i, :len(retrieved)] = [doc in relevant
+                                              for doc in retrieved]
+        # running count of relevant docs down each ranking
+        self.cum_hits = np.cumsum(self.hits, axis=1)
 
     def calc_metrics(self):
-        for query_id in self.retrieved.keys():
-            if self.relevant[query_id]:
-                self.metrics[query_id] = {}
-                inner_dict = self.metrics[query_id]
-                precision = self.calc_precision(query_id, self.num_docs)
-                recall = self.calc_recall(query_id)
-                inner_dict['precision'] = precision
-                inner_dict['recall'] = recall
-                inner_dict['p@5'] = self.calc_precision(query_id, 5)
-                inner_dict['r-prec'] = self.calc_precision(query_id, len(
-                    self.relevant[query_id]))
-                inner_dict['RR'] = self.calc_rr(query_id)
-                inner_dict['AP'] = self.calc_ap(query_id)
-                inner_dict['F1'] = self.calc_fscore(precision, recall, 1)
-                inner_dict['F.2'] = self.calc_fscore(precision, recall, 0.2)
+        """All metrics for every topic at depth num_docs, in one pass."""
+        k = self.num_docs
+        precision = self.calc_precision(k)
+        recall = self.calc_recall(k)
+        columns = {
+            'precision': precision,
+            'recall': recall,
+            'p@5': self.calc_precision(5),
+            'r-prec': self.calc_rprecision(),
+            'RR': self.calc_rr(),
+            'AP': self.calc_ap(),
+            'F1': self.calc_fscore(precision, recall, 1),
+            'F.2': self.calc_fscore(precision, recall, 0.2)
+        }
+        metrics = pd.DataFrame(columns, index=self.query_ids)
+        self.metrics = metrics.T.to_dict()
 
     def pr_curve(self, max_range):
-        precision = []
-        recall = []
-        for k in range(1, max_range + 1):
-            self.num_docs = k
-            self.evaluate()
-
-            precision.append(self.averages['precision'])
-            recall.append(self.averages['recall'])
+        """Mean precision and recall at each depth from 1 to max_range."""
+        if self.depth < max_range:
+            self.query_many(max_range)
+        depths = np.arange(1, max_range + 1)
+        precision = (self.cum_hits[:, :max_range] / depths.astype(
+            np.float64)).mean(axis=0)
+        recall = (self.cum_hits[:, :max_range] /
+                  self.num_relevant[:, None]).mean(axis=0)
         pr = pd.DataFrame([precision, recall]).T
         pr.columns = ['precision', 'recall']
         return pr
 
-    def calc_precision(self, query_id, d):
-        """Get precision at depth d of one query."""
-        # precision = (intersection of retrieved and relevant at depth d)/ d
-        # retrieved_list will be sliced to precision @ d for re-usability
+    def interpolated_pr(self, max_range=None):
+        """Mean 11-point interpolated precision, over rankings to max_range.
+
+        Interpolated precision at recall r is the best precision at any
+        depth whose recall is at least r.
+        """
+        max_range = max_range or self.depth
+        if self.depth < max_range:
+            self.query_many(max_range)
+        cum_hits = self.cum_hits[:, :max_range]
+        precision = cum_hits / np.arange(1.0, max_range + 1)
+        recall = cum_hits / self.num_relevant[:, None]
 
-        return (float(len(list(set(self.retrieved[query_id][:d]) &
-                set(self.relevant[query_id])))) / float(d))
+        # best precision at this depth or any deeper one
+        best = np.maximum.accumulate(precision[:, ::-1], axis=1)[:, ::-1]
+        levels = np.linspace(0, 1, 11)
+        curve = np.zeros((len(self.query_ids), len(levels)))
+        for j, level in enumerate(levels):
+            # first depth reaching the recall level, if any
+            reached = recall >= level - 1e-12
+            first = reached.argmax(axis=1)
+            found = reached.any(axis=1)
+            curve[found, j] = best[found, first[found]]
+        pr = pd.DataFrame({'recall': levels,
+                           'precision': curve.mean(axis=0)})
+        return pr[['recall', 'precision']]
 
-    def calc_recall(self, query_id):
-        """Get recall on one query."""
+    def ranking_metrics(self, rankings):
+        """AP and precision at num_docs of one ranking per topic.
+
+        rankings are lists of blog ids, in query_ids order, and are not
+        padded out to num_docs.
+        """
+        k = self.num_docs
+        hits = np.zeros((len(self.query_ids), k), dtype=bool)
+        for i, (query_id, ranking) in enumerate(zip(self.query_ids,
+                                                    rankings)):
+            relevant = set(self.relevant[query_id])
+            hits[i, :len(ranking[:k])] = [doc in relevant
+                                          for doc in ranking[:k]]
+        cum_hits = np.cumsum(hits, axis=1)
+        precisions = cum_hits / np.arange(1.0, k + 1)
+        return ((precisions * hits).sum(axis=1) / self.num_relevant,
+                cum_hits[:, -1] / float(k))
+
+    def budget_loss(self, budgets, unit='postings'):
+        """Effectiveness of budgeted retrieval against exact retrieval.
+
+        Ranks every topic with query_budget at each budget, a number of
+        postings or, with unit 'seconds', of seconds. Returns a DataFrame
+        by budget of MAP and precision at num_docs, how much of each is
+        lost against exact retrieval, the mean share of the exact top
+        num_docs found, the share of topics answered exactly, and the mean
+        score bound and milliseconds per query.
+        """
+        if unit not in ('postings', 'seconds'):
+            raise Exception('Error: budgets are in postings or seconds.')
+        engine = self.search_engine
+        k = self.num_docs
+        queries = [self.query_dict[query_id] for query_id in self.query_ids]
+        with self.stats.timer('budget_loss'):
+            exact = [list(engine.query(query, k)['id']) for query in queries]
+            # built up front, so no budget is spent building them
+            engine.build_impacts()
+            exact_ap, exact_p = self.ranking_metrics(exact)
+            rows = list()
+            for budget in budgets:
+                retrieved = list()
+                bounds = list()
+                start = time.time()
+                for query in queries:
+                    results, bound = engine.query_budget(
+                        query, k, **{unit: budget})
+                    retrieved.append(list(results['id']))
+                    bounds.append(bound)
+                seconds = time.time() - start
+                ap, precision = self.ranking_metrics(retrieved)
+                overlap = np.mean([
+                    len(set(ranking) & set(best)) / float(max(len(best), 1))
+                    for (ranking, best) in zip(retrieved, exact)])
+                rows.append([budget, ap.mean(), precision.mean(),
+                             exact_ap.mean() - ap.mean(),
+                             exact_p.mean() - precision.mean(), overlap,
+                             np.mean(np.array(bounds) == 0), np.mean(bounds),
+                             1000 * seconds / max(len(queries), 1)])
+        return pd.DataFrame(rows, columns=[
+            unit, 'MAP', 'precision', 'MAP loss', 'precision loss',
+            'overlap', 'exact', 'bound', 'ms']).set_index(unit)
+
+    def calc_precision(self, d):
+        """Get precision at depth d of every query."""
+        # precision = (intersection of retrieved and relevant at depth d)/ d
+        return self.cum_hits[:, min(d, self.num_docs) - 1] / float(d)
+
+    def calc_recall(self, d):
+        """Get recall at depth d of every query."""
         # intersection of retrieved and relevant / number relevant
-        num_relevant = len(self.relevant[query_id])
-        return (float(len(list(set(self.retrieved[query_id]) &
-                set(self.relevant[query_id])))) / float(num_relevant))
+        return (self.cum_hits[:, min(d, self.num_docs) - 1] /
+                self.num_relevant)
 
-    def calc_ap(self, query_id):
+    def calc_rprecision(self):
+        """Get precision at depth R, the number of relevant docs."""
+        depths = np.minimum(self.num_relevant.astype(int), self.num_docs)
+        rows = np.arange(len(self.query_ids))
+        return self.cum_hits[rows, depths - 1] / self.num_relevant
+
+    def calc_ap(self):
         """Get the avg precision at each correct match retrieved."""
-        retrieved = self.retrieved[query_id]
-        precisions = []
-        for doc in retrieved:
-            if doc in self.relevant[query_id]:
-                precisions.append(self.calc_precision(query_id,
-                                  retrieved.index(doc) + 1))
-        return float(sum(precisions)) / float(len(self.relevant[query_id]))
-
-    def calc_rr(self, query_id):
+        hits = self.hits[:, :self.num_docs]
+        cum_hits = self.cum_hits[:, :self.num_docs]
+        precisions = cum_hits / np.arange(1.0, self.num_docs + 1)
+        return (precisions * hits).sum(axis=1) / self.num_relevant
+
+    def calc_rr(self):
         """Get reciprocal rank, the reciprocal of rank of first relevant."""
-        retrieved = self.retrieved[query_id]
-        for doc in retrieved:
-            # find rank of first correct answer
-            if doc in self.relevant[query_id]:
-                return 1.0 / float(retrieved.index(doc) + 1)
-        return None
+        hits = self.hits[:, :self.num_docs]
+        # NaN where nothing relevant was retrieved
+        first = hits.argmax(axis=1) + 1.0
+        return np.where(hits.any(axis=1), 1.0 / first, np.nan)
 
     def calc_fscore(self, precision, recall, beta):
-        """Get f-score."""
-        if precision == 0 or recall == 0:
-            return None
-        else:
-            return (((1.0 + beta**2) * (precision * recall)) /
-                    ((beta**2) * precision + recall))
+        """Get f-score, NaN where precision or recall is 0."""
+        with np.errstate(invalid='ignore', divide='ignore'):
+            fscore = (((1.0 + beta**2) * (precision * recall)) /
+                      ((beta**2) * precision + recall))
+        return np.where((precision == 0) | (recall == 0), np.nan, fscore)
 
     def query_read(self, query_str):
         """Inspect results."""
@@ -0,0 +1,351 @@
+"""Evaluate a grid of SearchEngine variants over one tokenization pass.
+
+The corpus is read and tokenized once per tokenize pattern into a token
+store, an on-disk array of token ids into a vocabulary with case kept and
+nothing dropped or stemmed. Each variant's terms come from lowercasing,
+stopping and stemming the vocabulary, not every token, and its postings
+from counting mapped token ids.
+"""
+import os
+import time
+import random
+import hashlib
+import tempfile
+from array import array
+from itertools import product
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+
+from search import SearchEngine
+from evaluator import Evaluator
+from judgments import Judgments, QRELS, TOPICS
+from index import InvertedIndex, write_arrays, read_arrays
+from tokenizer import Analyzer, english_stopwords
+from sources import DirectorySource
+
+# SearchEngine's tokenization defaults
+TOKENIZATION = {
+    'lowercase': True,
+    'tokenize': 'no_digits',
+    'stopwords': True,
+    'stemming': None,
+    'lemmatize': False
+}
+
+# options a variant may set, all passed on to its SearchEngine
+OPTIONS = sorted(TOKENIZATION) + ['biwords', 'english_only', 'normalize']
+
+STORE_NAME = 'tokens-{}.bin'
+
+# the runner of a run, inherited by forked pool workers
+_runner = None
+
+
+def fingerprint(source, parts):
+    """Changes whenever the parts of a source change."""
+    digest = hashlib.md5(repr(type(source)))
+    for part in parts:
+        info = os.stat(part)
+        digest.update('{}\0{}\0{}\0'.format(part, info.st_size,
+                                            info.st_mtime))
+    return digest.hexdigest()
+
+
+class TokenStore(object):
+    """The tokens of every document of a corpus, as vocabulary ids.
+
+    Doc id i's tokens are tokens[offsets[i - 1]:offsets[i]], ids into
+    vocab, the distinct words of the tokenize pattern with case kept.
+    blog_ids and blank_docs are as for SearchEngine.set_index.
+    """
+
+    def __init__(self, vocab, tokens, offsets, blog_ids, blank_docs):
+        self.vocab = vocab
+        self.tokens = tokens
+        self.offsets = offsets
+        self.blog_ids = blog_ids
+        self.blank_docs = blank_docs
+
+    @classmethod
+    def build(cls, source, parts, patterns):
+        """Read parts once, tokenizing each doc with every pattern.
+
+        Returns a store per pattern.
+        """
+        analyzers = dict((pattern, Analyzer(lowercase=False,
+                                            tokenize=pattern,
+                                            stopwords=True))
+                         for pattern in patterns)
+        vocabs = dict((pattern, {}) for pattern in patterns)
+        tokens = dict((pattern, array('i')) for pattern in patterns)
+        offsets = dict((pattern, [0]) for pattern in patterns)
+        blog_ids = list()
+        blank_docs = list()
+        for part in parts:
+            for blog_id, doc in source.read(part):
+                blog_ids.append(blog_id)
+                if not doc:
+                    blank_docs.append(len(blog_ids))
+                for pattern, analyzer in analyzers.items():
+                    if doc:
+                        vocab = vocabs[pattern]
+                        words = analyzer.pattern.findall(analyzer.text(doc))
+                        tokens[pattern].extend(
+                            vocab.setdefault(word, len(vocab))
+                            for word in words)
+                    offsets[pattern].append(len(tokens[pattern]))
+
+        stores = {}
+        for pattern in patterns:
+            vocab = vocabs[pattern]
+            stores[pattern] = cls(
+                np.array([word.encode('utf-8') for word
+                          in sorted(vocab, key=vocab.get)],
+                         dtype=np.string_),
+                np.frombuffer(tokens[pattern], dtype=np.intc),
+                np.array(offsets[pattern], dtype=np.int64),
+                np.array(blog_ids, dtype=np.string_),
+                np.array(blank_docs, dtype=np.int32))
+        return stores
+
+    @classmethod
+    def load(cls, path):
+        """Load a saved store, with its tokens memory-mapped."""
+        arrays, meta = read_arrays(path)
+        return cls(arrays['vocab'], arrays['tokens'], arrays['offsets'],
+                   arrays['blog_ids'], arrays['blank_docs']), meta
+
+    def save(self, path, meta=None):
+        write_arrays(path, {
+            'vocab': self.vocab,
+            'tokens': self.tokens,
+            'offsets': self.offsets,
+            'blog_ids': self.blog_ids,
+            'blank_docs': self.blank_docs
+        }, meta or {})
+
+    @property
+    def num_docs(self):
+        return len(self.offsets) - 1
+
+    def words(self):
+        """The vocabulary as unicode words."""
+        return [word.decode('utf-8') for word in self.vocab.tolist()]
+
+    def doc_ids(self):
+        """Doc id of every token."""
+        return np.repeat(np.arange(1, self.num_docs + 1, dtype=np.int64),
+                         np.diff(self.offsets))
+
+
+def _top_per_doc(docs, keys, counts, n):
+    # mask of the n highest counts of each doc, ties to the lower key
+    order = np.lexsort((keys, -counts, docs))
+    sorted_docs = docs[order]
+    rank = np.arange(len(order)) - np.searchsorted(sorted_docs, sorted_docs)
+    top = np.zeros(len(order), dtype=bool)
+    top[order] = rank < n
+    return top
+
+
+def _count_pairs(docs, keys):
+    # distinct (doc, key) pairs and how often each occurs
+    width = keys.max() + 1 if len(keys) else 1
+    codes, counts = np.unique(docs * width + keys, return_counts=True)
+    return codes // width, codes % width, counts
+
+
+def variant_postings(store, options):
+    """The terms and (term id, doc id, tf) postings of one variant.
+
+    Works as SearchEngine does over documents, except that ties between
+    equally frequent words in the English check, and between bigrams,
+    go to the word or bigram with the lower id rather than to dict order.
+    """
+    tokenization = dict(TOKENIZATION)
+    tokenization.update((key, options[key]) for key in TOKENIZATION
+                        if key in options)
+    if options.get('biwords'):
+        tokenization['stopwords'] = False
+    analyzer = Analyzer(**tokenization)
+
+    # each vocabulary word as the variant's term, and if it is dropped
+    terms = {}
+    words = store.words()
+    term_ids = np.empty(len(words), dtype=np.int64)
+    dropped = np.zeros(len(words), dtype=bool)
+    for i, word in enumerate(words):
+        if analyzer.lowercase:
+            word = word.lower()
+        dropped[i] = word in analyzer.stop
+        if analyzer.stem is not None:
+            word = analyzer.stem(word)
+        term_ids[i] = terms.setdefault(word, len(terms))
+    terms = sorted(terms, key=terms.get)
+
+    tokens = store.tokens
+    docs = store.doc_ids()
+    kept = ~dropped[tokens]
+    tokens = term_ids[tokens]
+    if options.get('english_only'):
+        # at least 2 of a doc's 3 most frequent words, stopwords included,
+        # must be stopwords
+        stop = np.array([term in english_stopwords() for term in terms],
+                        dtype=bool)
+        pair_docs, pair_terms, counts = _count_pairs(docs, tokens)
+        top = _top_per_doc(pair_docs, pair_terms, counts, 3)
+        english = np.bincount(pair_docs[top], weights=stop[pair_terms[top]],
+                              minlength=store.num_docs + 1) >= 2
+        kept &= english[docs]
+    docs, tokens = docs[kept], tokens[kept]
+    post_docs, post_terms, tfs = _count_pairs(docs, tokens)
+
+    if options.get('biwords'):
+        # the top 3 bigrams of each doc, if they occur more than once
+        num_words = len(terms)
+        same = docs[1:] == docs[:-1]
+        pair_docs, pairs, counts = _count_pairs(
+            docs[1:][same], tokens[:-1][same] * num_words + tokens[1:][same])
+        top = _top_per_doc(pair_docs, pairs, counts, 3) & (counts > 1)
+        bigrams, bigram_ids = np.unique(pairs[top], return_inverse=True)
+        terms = terms + [(terms[pair // num_words], terms[pair % num_words])
+                         for pair in bigrams.tolist()]
+        post_docs = np.concatenate([post_docs, pair_docs[top]])
+        post_terms = np.concatenate([post_terms, num_words + bigram_ids])
+        tfs = np.concatenate([tfs, counts[top]])
+
+    # only terms with postings are kept
+    used, post_terms = np.unique(post_terms, return_inverse=True)
+    return ([terms[term_id] for term_id in used.tolist()], post_terms,
+            post_docs, tfs)
+
+
+def grid(**choices):
+    """Every combination of some options' values, as named variants.
+
+    grid(stemming=[None, 'porter'], biwords=[False, True]) has four
+    variants, named by their options, e.g. 'biwords=True,stemming=porter'.
+    """
+    keys = sorted(choices)
+    variants = {}
+    for values in product(*[choices[key] for key in keys]):
+        options = dict(zip(keys, values))
+        name = ','.join('{}={}'.format(key, options[key]) for key in keys)
+        variants[name] = options
+    return variants
+
+
+def _run_variant(name):
+    return _runner.run_variant(name)
+
+
+class ExperimentRunner(object):
+    """Build and evaluate many SearchEngine variants of one corpus.
+
+    Token stores are kept in cache_dir and reused until the corpus
+    changes. Variants are built from them in workers processes, which
+    share the stores' memory-mapped tokens, and are all evaluated against
+    one Judgments, loaded from the qrels and topic files if not given.
+    """
+
+    def __init__(self, source=None, corpus_dir='corpus/', cache_dir=None,
+                 workers=1, num_docs=10, judgments=None,
+                 relevant_file=QRELS, topic_file=TOPICS):
+        if source is None:
+            source = DirectorySource(corpus_dir)
+        self.source = source
+        self.corpus_dir = corpus_dir
+        self.cache_dir = cache_dir or os.path.join(
+            tempfile.gettempdir(), 'searchengine-experiments')
+        self.workers = workers
+        self.num_docs = num_docs
+        if judgments is None:
+            judgments = Judgments.load(relevant_file, topic_file)
+        self.judgments = judgments
+        self.variants = {}
+        self.results = None
+
+    def store_path(self, pattern):
+        return os.path.join(self.cache_dir, STORE_NAME.format(pattern))
+
+    def prepare(self, patterns):
+        """Make sure a current token store exists for every pattern."""
+        parts = self.source.parts()
+        key = fingerprint(self.source, parts)
+        missing = list()
+        for pattern in sorted(set(patterns)):
+            path = self.store_path(pattern)
+            if (not os.path.exists(path) or
+                    read_arrays(path)[1].get('source') != key):
+                missing.append(pattern)
+        if missing:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            stores = TokenStore.build(self.source, parts, missing)
+            for pattern, store in stores.items():
+                store.save(self.store_path(pattern), {'source': key})
+
+    def run_variant(self, name):
+        """Build and evaluate one variant, as a row of the results."""
+        options = self.variants[name]
+        random.seed(0)
+        try:
+            start = time.time()
+            store, meta = TokenStore.load(self.store_path(
+                options.get('tokenize', 'no_digits')))
+            terms, term_ids, doc_ids, tfs = variant_postings(store, options)
+            engine = SearchEngine.from_index(
+                InvertedIndex.from_triples(terms, term_ids, doc_ids, tfs),
+                store.blank_docs.tolist(), store.blog_ids.tolist(),
+                corpus_dir=self.corpus_dir, **options)
+            built = time.time()
+            evaluator = Evaluator(engine, num_docs=self.num_docs,
+                                  judgments=self.judgments)
+        except Exception as error:
+            return {'error': '{}: {}'.format(type(error).__name__, error)}
+        row = evaluator.averages.to_dict()
+        row.update({'terms': len(engine.index), 'postings': len(tfs),
+                    'build_seconds': built - start,
+                    'eval_seconds': time.time() - built})
+        return row
+
+    def run(self, variants):
+        """Evaluate named variants, a dict of name: SearchEngine options.
+
+        Returns one row per variant, best AP first, with the mean of each
+        metric, the terms and postings indexed, and the seconds spent
+        building and evaluating. A variant that fails, e.g. for missing
+        nltk data, gets an error instead.
+        """
+        global _runner
+        for name, options in variants.items():
+            unknown = set(options) - set(OPTIONS)
+            if unknown:
+                raise Exception('Error: unknown options {} in {}.'.format(
+                    ', '.join(sorted(unknown)), name))
+        self.variants = variants
+        self.prepare([options.get('tokenize', 'no_digits')
+                      for options in variants.values()])
+
+        names = sorted(variants)
+        _runner = self
+        try:
+            if self.workers > 1:
+                pool = Pool(self.workers)
+                rows = pool.map(_run_variant, names)
+                pool.close()
+                pool.join()
+            else:
+                rows = map(_run_variant, names)
+        finally:
+            _runner = None
+
+        results = pd.DataFrame(rows, index=names)
+        if 'AP' in results:
+            # stable, so ties keep name order
+            results = results.sort_values('AP', ascending=False,
+                                          kind='mergesort')
+        self.results = results
+        return results
@@ -0,0 +1,735 @@
+import os
+import json
+import mmap
+import struct
+from array import array
+
+import numpy as np
+
+# on-disk layout: magic, header length, json header, then 64-byte aligned
+# arrays described by the header
+MAGIC = 'SEIDX002'
+ALIGN = 64
+
+# postings per block of the skip lists
+BLOCK_SIZE = 128
+
+# weights of an impact-ordered segment fall into 2 ** IMPACT_BITS bands
+IMPACT_BITS = 8
+
+
+def encode_term(term):
+    """Turn an index term (word or biword tuple) into a byte string key."""
+    if isinstance(term, tuple):
+        term = u' '.join(term)
+    if isinstance(term, unicode):
+        term = term.encode('utf-8')
+    return term
+
+
+def decode_term(key):
+    """Inverse of encode_term."""
+    term = key.decode('utf-8')
+    if u' ' in term:
+        return tuple(term.split(u' '))
+    return term
+
+
+def vbyte_lengths(values):
+    """Bytes taken by each value in variable-byte code."""
+    nbytes = np.ones(len(values), dtype=np.int64)
+    for bits in range(7, 64, 7):
+        nbytes += values >= (1 << bits)
+    return nbytes
+
+
+def vbyte_encode(values):
+    """Variable-byte code an array of non-negative ints.
+
+    Each value takes 7 bits a byte, low bits first, with the high bit set
+    on every byte but its last.
+    """
+    values = np.asarray(values, dtype=np.int64)
+    nbytes = vbyte_lengths(values)
+    ends = np.cumsum(nbytes)
+    owner = np.repeat(np.arange(len(values)), nbytes)
+    shift = np.arange(ends[-1] if len(ends) else 0) - (ends - nbytes)[owner]
+    data = (values[owner] >> (7 * shift)) & 0x7f
+    data |= (shift < nbytes[owner] - 1) << 7
+    return data.astype(np.uint8)
+
+
+def vbyte_decode(data):
+    """Inverse of vbyte_encode, as an int64 array."""
+    data = np.asarray(data, dtype=np.uint8)
+    if not len(data):
+        return np.zeros(0, dtype=np.int64)
+    ends = np.flatnonzero(data < 0x80)
+    starts = np.empty(len(ends), dtype=np.int64)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+    shift = np.arange(len(data)) - np.repeat(starts, ends - starts + 1)
+    values = (data & 0x7f).astype(np.int64) << (7 * shift)
+    return np.add.reduceat(values, starts)
+
+
+def gather_runs(values, starts, lengths):
+    """Concatenate values[starts[i]:starts[i] + lengths[i]] over all i."""
+    lengths = np.asarray(lengths, dtype=np.int64)
+    ends = np.cumsum(lengths)
+    index = np.arange(ends[-1] if len(ends) else 0) - np.repeat(
+        ends - lengths - starts, lengths)
+    return values[index]
+
+
+def run_cumsum(values, lengths):
+    """Running sums of values that start over at each run of lengths."""
+    lengths = np.asarray(lengths, dtype=np.int64)
+    sums = np.cumsum(values, dtype=np.int64)
+    before = np.concatenate([[0], sums])[np.cumsum(lengths) - lengths]
+    return sums - np.repeat(before, lengths)
+
+
+def write_arrays(path, arrays, meta):
+    """Write a dict of numpy arrays plus json metadata to one binary file.
+
+    The file is written beside path and renamed over it, so processes that
+    have the old file mapped keep reading it intact.
+    """
+    layout = {}
+    offset = 0
+    for name in sorted(arrays.keys()):
+        arr = np.ascontiguousarray(arrays[name])
+        arrays[name] = arr
+        layout[name] = {'dtype': arr.dtype.str,
+                        'shape': list(arr.shape),
+                        'offset': offset}
+        offset += arr.nbytes
+        offset += -offset % ALIGN
+
+    header = json.dumps({'meta': meta, 'arrays': layout})
+    start = len(MAGIC) + 8 + len(header)
+    start += -start % ALIGN
+
+    f = open(path + '.tmp', 'wb')
+    f.write(MAGIC)
+    f.write(struct.pack('<Q', start))
+    f.write(header)
+    for name in sorted(arrays.keys()):
+        f.seek(start + layout[name]['offset'])
+        f.write(arrays[name].tostring())
+    f.truncate(start + offset)
+    f.close()
+    os.rename(path + '.tmp', path)
+
+
+def read_arrays(path, use_mmap=True):
+    """Read a file written by write_arrays, memory-mapping it by default.
+
+    Mapped arrays are read-only and backed by the page cache, so several
+    processes loading the same file share one copy of the data.
+    """
+    f = open(path, 'rb')
+    if f.read(len(MAGIC)) != MAGIC:
+        f.close()
+        raise Exception('Error: {} is not a saved index.'.format(path))
+    start = struct.unpack('<Q', f.read(8))[0]
+    header = json.loads(f.read(start - len(MAGIC) - 8).rstrip('\0'))
+    if use_mmap:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    else:
+        f.seek(0)
+        buf = f.read()
+    f.close()
+
+    arrays = {}
+    for name, info in header['arrays'].items():
+        dtype = np.dtype(str(info['dtype']))
+        count = int(np.prod(info['shape']))
+        arrays[str(name)] = np.frombuffer(
+            buf, dtype, count, start + info['offset']).reshape(info['shape'])
+    return arrays, header['meta']
+
+
+def find_term(terms, term):
+    """Position of term in a sorted array of encoded terms, or -1."""
+    key = encode_term(term)
+    i = np.searchsorted(terms, key)
+    if i < len(terms) and terms[i] == key:
+        return int(i)
+    return -1
+
+
+class Segment(object):
+    """Immutable postings of a run of docs in CSR layout.
+
+    The postings of term id t are doc_ids[offsets[t]:offsets[t + 1]] with
+    the matching term frequencies in tfs. Doc ids increase within each
+    postings list, and term ids past the end of offsets have no postings.
+
+    A positional segment also holds the positions of every posting, tf of
+    them each, one posting after another in positions. Each posting's
+    positions are stored as the first and then the gaps between them.
+    """
+
+    def __init__(self, offsets, doc_ids, tfs, positions=None):
+        self.offsets = offsets
+        self.doc_ids = doc_ids
+        self.tfs = tfs
+        self.positions = positions
+        self.pos_offsets = None
+
+    @classmethod
+    def from_triples(cls, term_ids, doc_ids, tfs, num_terms, positions=None):
+        """Build from parallel arrays of (term id, doc id, tf) in any order.
+
+        positions, if given, are the postings' position gaps in the same
+        order as the triples.
+        """
+        order = np.lexsort((doc_ids, term_ids))
+        offsets = np.zeros(num_terms + 1, dtype=np.int64)
+        np.cumsum(np.bincount(term_ids, minlength=num_terms),
+                  out=offsets[1:])
+        if positions is not None:
+            starts = np.cumsum(tfs, dtype=np.int64) - tfs
+            positions = gather_runs(positions, starts[order], tfs[order])
+            positions = positions.astype(np.min_scalar_type(
+                positions.max() if len(positions) else 0))
+        # term frequencies are small, store them in the smallest dtype
+        tf_dtype = np.min_scalar_type(tfs.max() if len(tfs) else 0)
+        return cls(offsets, doc_ids[order].astype(np.int32),
+                   tfs[order].astype(tf_dtype), positions)
+
+    @classmethod
+    def merge(cls, segments, num_terms, keep=None):
+        """Merge segments into one, dropping docs where keep is False."""
+        term_ids = np.concatenate([seg.term_ids() for seg in segments])
+        doc_ids = np.concatenate([seg.doc_ids for seg in segments])
+        tfs = np.concatenate([seg.tfs for seg in segments])
+        positions = None
+        if all(seg.positions is not None for seg in segments):
+            positions = np.concatenate([seg.positions.astype(np.int64)
+                                        for seg in segments])
+        if keep is not None:
+            live = keep[doc_ids]
+            if positions is not None:
+                positions = positions[np.repeat(live, tfs)]
+            term_ids, doc_ids, tfs = (term_ids[live], doc_ids[live],
+                                      tfs[live])
+        return cls.from_triples(term_ids, doc_ids, tfs, num_terms, positions)
+
+    @property
+    def num_terms(self):
+        return len(self.offsets) - 1
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def term_ids(self):
+        """Term id of every posting."""
+        return np.repeat(np.arange(self.num_terms), np.diff(self.offsets))
+
+    def doc_freqs(self):
+        return np.diff(self.offsets)
+
+    def postings(self, term_id):
+        """Doc ids and term frequencies of one term."""
+        if term_id >= self.num_terms:
+            return self.doc_ids[:0], self.tfs[:0]
+        start, end = self.offsets[term_id], self.offsets[term_id + 1]
+        return self.doc_ids[start:end], self.tfs[start:end]
+
+    def term_positions(self, term_id, docs=None):
+        """Doc ids, position counts and positions of one term's postings.
+
+        Only the postings of docs, a sorted array, are decoded if given.
+        """
+        if self.pos_offsets is None:
+            # where each term's positions start
+            self.pos_offsets = np.concatenate(
+                [[0], np.cumsum(self.tfs, dtype=np.int64)])[self.offsets]
+        term_docs, tfs = self.postings(term_id)
+        if not len(term_docs):
+            return term_docs, tfs, np.zeros(0, dtype=np.int64)
+        starts = (self.pos_offsets[term_id] +
+                  np.cumsum(tfs, dtype=np.int64) - tfs)
+        if docs is not None:
+            found = np.minimum(np.searchsorted(term_docs, docs),
+                               len(term_docs) - 1)
+            found = found[term_docs[found] == docs]
+            term_docs, tfs, starts = (term_docs[found], tfs[found],
+                                      starts[found])
+        return term_docs, tfs, run_cumsum(
+            gather_runs(self.positions, starts, tfs), tfs)
+
+    def blocks(self, term_id):
+        """Last doc id of each BLOCK_SIZE block of a term's postings."""
+        docs = self.postings(term_id)[0]
+        return docs[np.minimum(np.arange(BLOCK_SIZE, len(docs) + BLOCK_SIZE,
+                                         BLOCK_SIZE), len(docs)) - 1]
+
+    def block(self, term_id, b):
+        """Doc ids and term frequencies of one block of a term."""
+        start = self.offsets[term_id] + b * BLOCK_SIZE
+        end = min(start + BLOCK_SIZE, self.offsets[term_id + 1])
+        return self.doc_ids[start:end], self.tfs[start:end]
+
+
+class CompressedSegment(Segment):
+    """Segment with postings stored as variable-byte codes.
+
+    Each posting is its d-gap then its term frequency, both variable-byte
+    coded in data. Each postings list is cut into blocks of BLOCK_SIZE,
+    one term's blocks after another, and block_starts holds where each
+    block's bytes begin in data, so a block is decoded without the ones
+    before it. For lists of more than one block, block_last holds the last
+    doc id of every block, a skip list for finding the block that could
+    hold a doc. Where each term's blocks and skips begin is worked out
+    from offsets rather than stored.
+
+    impacts optionally hold every posting's weight quantized to 8 or 16
+    bits, in units of impact_scale.
+    """
+
+    def __init__(self, offsets, block_last, block_starts, data,
+                 impacts=None, impact_scale=None, positions=None):
+        self.offsets = offsets
+        self.block_last = block_last
+        self.block_starts = block_starts
+        self.data = data
+        self.impacts = impacts
+        self.impact_scale = impact_scale
+        self.positions = positions
+        self.pos_offsets = None
+
+        # first block and first skip of each term
+        self.num_blocks = -(-np.diff(offsets) // BLOCK_SIZE)
+        self.block_offsets = np.zeros(len(offsets), dtype=np.int64)
+        np.cumsum(self.num_blocks, out=self.block_offsets[1:])
+        self.skip_offsets = np.zeros(len(offsets), dtype=np.int64)
+        np.cumsum(np.where(self.num_blocks > 1, self.num_blocks, 0),
+                  out=self.skip_offsets[1:])
+
+    @classmethod
+    def from_segment(cls, segment, weights=None, impact_bits=None):
+        """Compress a segment, quantizing weights to impact_bits if given."""
+        offsets = segment.offsets
+        doc_ids = segment.doc_ids.astype(np.int64)
+        gaps = np.diff(np.concatenate([[0], doc_ids]))
+        # each list starts over from doc 0
+        starts = offsets[:-1][np.diff(offsets) > 0]
+        gaps[starts] = doc_ids[starts]
+        values = np.empty(2 * len(gaps), dtype=np.int64)
+        values[0::2] = gaps
+        values[1::2] = segment.tfs
+        nbytes = vbyte_lengths(values)
+        byte_offsets = np.zeros(len(gaps) + 1, dtype=np.int64)
+        np.cumsum(nbytes[0::2] + nbytes[1::2], out=byte_offsets[1:])
+
+        # first and last posting of every block
+        num_blocks = -(-np.diff(offsets) // BLOCK_SIZE)
+        block_offsets = np.zeros(len(offsets), dtype=np.int64)
+        np.cumsum(num_blocks, out=block_offsets[1:])
+        terms = np.repeat(np.arange(len(num_blocks)), num_blocks)
+        first = offsets[terms] + BLOCK_SIZE * (
+            np.arange(block_offsets[-1]) - block_offsets[terms])
+        last = np.minimum(first + BLOCK_SIZE, offsets[terms + 1]) - 1
+
+        impacts = None
+        impact_scale = None
+        if impact_bits is not None:
+            if impact_bits not in (8, 16):
+                raise Exception('Error: impacts are 8 or 16 bits.')
+            top = weights.max() if len(weights) else 0
+            impact_scale = float(top) / (2 ** impact_bits - 1) or 1.0
+            impacts = np.rint(weights / impact_scale)
+            # matching docs keep a nonzero weight
+            impacts = np.maximum(impacts, weights > 0).astype(
+                np.uint8 if impact_bits == 8 else np.uint16)
+        start_dtype = np.uint32 if byte_offsets[-1] < 2 ** 32 else np.int64
+        return cls(offsets, doc_ids[last[num_blocks[terms] > 1]].astype(
+                       np.int32),
+                   np.append(byte_offsets[first], byte_offsets[-1]).astype(
+                       start_dtype),
+                   vbyte_encode(values), impacts, impact_scale,
+                   segment.positions)
+
+    def decode_all(self):
+        """Doc ids and term frequencies of every posting."""
+        values = vbyte_decode(self.data)
+        # restart the running sum of gaps at each list
+        docs = np.cumsum(values[0::2])
+        before = np.concatenate([[0], docs])[self.offsets[:-1]]
+        docs -= np.repeat(before, np.diff(self.offsets))
+        return docs.astype(np.int32), values[1::2].astype(np.int32)
+
+    @property
+    def doc_ids(self):
+        return self.decode_all()[0]
+
+    @property
+    def tfs(self):
+        return self.decode_all()[1]
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def decode(self, first_block, end_block, base=0):
+        # doc ids and tfs of a run of blocks from one list
+        values = vbyte_decode(self.data[self.block_starts[first_block]:
+                                        self.block_starts[end_block]])
+        return ((base + np.cumsum(values[0::2])).astype(np.int32),
+                values[1::2].astype(np.int32))
+
+    def postings(self, term_id):
+        if term_id >= self.num_terms:
+            return (np.zeros(0, dtype=np.int32),
+                    np.zeros(0, dtype=np.int32))
+        return self.decode(self.block_offsets[term_id],
+                           self.block_offsets[term_id + 1])
+
+    def blocks(self, term_id):
+        if term_id >= self.num_terms:
+            return self.block_last[:0]
+        num_blocks = self.num_blocks[term_id]
+        if num_blocks > 1:
+            start = self.skip_offsets[term_id]
+            return self.block_last[start:start + num_blocks]
+        # a single block ends with the list's last doc
+        return self.postings(term_id)[0][-1:]
+
+    def block(self, term_id, b):
+        first_block = self.block_offsets[term_id] + b
+        base = 0
+        if b:
+            base = self.block_last[self.skip_offsets[term_id] + b - 1]
+        return self.decode(first_block, first_block + 1, base)
+
+    def impact_block(self, term_id, b):
+        """Doc ids and dequantized weights of one block of a term."""
+        docs, tfs = self.block(term_id, b)
+        start = self.offsets[term_id] + b * BLOCK_SIZE
+        return docs, self.impacts[start:start + len(docs)] * self.impact_scale
+
+    def impact_postings(self, term_id):
+        """Doc ids and dequantized weights of one term."""
+        docs, tfs = self.postings(term_id)
+        start = self.offsets[term_id] if term_id < self.num_terms else 0
+        return docs, self.impacts[start:start + len(docs)] * self.impact_scale
+
+
+class ImpactSegment(object):
+    """Postings of each term in descending weight order, cut into bands.
+
+    Term t's postings are doc_ids[offsets[t]:offsets[t + 1]] with their
+    weights, highest weight first and ties in doc order. Postings of a
+    term whose weights quantize to the same one of 2 ** bits levels form
+    a band. Term t's bands are band_offsets[t] up to band_offsets[t + 1],
+    band b holding postings band_starts[b] up to band_starts[b + 1].
+    """
+
+    def __init__(self, offsets, doc_ids, weights, band_offsets,
+                 band_starts):
+        self.offsets = offsets
+        self.doc_ids = doc_ids
+        self.weights = weights
+        self.band_offsets = band_offsets
+        self.band_starts = band_starts
+
+    @classmethod
+    def from_weights(cls, offsets, doc_ids, weights, bits=IMPACT_BITS):
+        """Reorder weighted postings in term order, as in a Segment."""
+        offsets = np.asarray(offsets, dtype=np.int64)
+        term_ids = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+        order = np.lexsort((doc_ids, -weights, term_ids))
+        doc_ids = np.asarray(doc_ids)[order].astype(np.int32)
+        weights = np.asarray(weights, dtype=np.float64)[order]
+
+        top = weights.max() if len(weights) else 0
+        levels = np.ceil(weights * ((2 ** bits - 1) / (top or 1.0)))
+        # a band starts at each term's first posting and at each drop
+        starts = np.flatnonzero(np.concatenate(
+            [[True], (term_ids[1:] != term_ids[:-1]) |
+             (levels[1:] != levels[:-1])]))[:len(weights)]
+        return cls(offsets, doc_ids, weights,
+                   np.searchsorted(starts, offsets),
+                   np.append(starts, len(weights)))
+
+    @property
+    def num_terms(self):
+        return len(self.offsets) - 1
+
+    def bands(self, term_id):
+        """Start of each band of a term, and the end of its last."""
+        if term_id >= self.num_terms:
+            return self.band_starts[:0]
+        return self.band_starts[self.band_offsets[term_id]:
+                                self.band_offsets[term_id + 1] + 1]
+
+
+class ForwardIndex(object):
+    """Term ids and term frequencies of each doc, in term id order.
+
+    Doc d's terms are term_ids[offsets[d]:offsets[d + 1]] with their
+    frequencies in tfs, the postings of a Segment turned doc-major. Rows
+    of docs added later are appended to a buffer, with their ends in
+    added_ends, so adding a doc costs only its own terms.
+    """
+
+    def __init__(self, offsets, term_ids, tfs):
+        self.offsets = offsets
+        self.term_ids = term_ids
+        self.tfs = tfs
+        self.added_ends = array('l')
+        self.added_term_ids = array('i')
+        self.added_tfs = array('i')
+
+    @classmethod
+    def from_segment(cls, segment, num_docs):
+        """Turn a segment's postings over, for doc ids below num_docs."""
+        doc_ids = segment.doc_ids
+        # stable, so each doc's terms stay in term id order
+        order = np.argsort(doc_ids, kind='mergesort')
+        offsets = np.zeros(num_docs + 1, dtype=np.int64)
+        np.cumsum(np.bincount(doc_ids, minlength=num_docs), out=offsets[1:])
+        return cls(offsets, segment.term_ids()[order].astype(np.int32),
+                   segment.tfs[order])
+
+    @property
+    def num_docs(self):
+        return len(self.offsets) - 1 + len(self.added_ends)
+
+    def append(self, doc_id, term_ids, tfs):
+        """Add the row of a new doc, after every doc so far.
+
+        Docs skipped over, such as blank ones, get empty rows.
+        """
+        while self.num_docs < doc_id:
+            self.added_ends.append(len(self.added_term_ids))
+        order = np.argsort(term_ids, kind='mergesort')
+        self.added_term_ids.extend(np.asarray(term_ids)[order].tolist())
+        self.added_tfs.extend(np.asarray(tfs)[order].tolist())
+        self.added_ends.append(len(self.added_term_ids))
+
+    def rows(self, docs):
+        """Terms of several docs, as (position in docs, term id, tf)."""
+        docs = np.asarray(docs, dtype=np.int64)
+        positions = np.arange(len(docs))
+        base = docs < len(self.offsets) - 1
+        starts = self.offsets[docs[base]]
+        lengths = self.offsets[docs[base] + 1] - starts
+        parts = [(np.repeat(positions[base], lengths),
+                  gather_runs(self.term_ids, starts, lengths),
+                  gather_runs(self.tfs, starts, lengths))]
+        if not base.all():
+            # rows from the buffer of added docs
+            ends = np.frombuffer(self.added_ends, dtype=np.int_)
+            added = docs[~base] - (len(self.offsets) - 1)
+            starts = np.concatenate([[0], ends])[added]
+            lengths = ends[added] - starts
+            parts.append((np.repeat(positions[~base], lengths),
+                          gather_runs(np.frombuffer(self.added_term_ids,
+                                                    dtype=np.intc),
+                                      starts, lengths),
+                          gather_runs(np.frombuffer(self.added_tfs,
+                                                    dtype=np.intc),
+                                      starts, lengths)))
+        if len(parts) == 1:
+            return parts[0]
+        return tuple(np.concatenate([part[i] for part in parts])
+                     for i in range(3))
+
+
+class InvertedIndex(object):
+    """Vocabulary plus postings held in segments and a write buffer.
+
+    Terms are numbered in the sorted terms array first, then in the order
+    they were added. New documents go into the in-memory buffer, which is
+    flushed into an immutable segment once it is big enough. Segments are
+    ordered by doc id, so postings concatenated across segments stay in
+    doc order.
+    """
+
+    def __init__(self, terms, segments):
+        self.terms = terms
+        self.segments = segments
+        self.positional = bool(segments) and all(
+            segment.positions is not None for segment in segments)
+        self.added = {}
+        self.added_terms = list()
+        self.buffer = {}
+        self.buffered_docs = 0
+
+    @classmethod
+    def from_triples(cls, terms, term_ids, doc_ids, tfs, positions=None):
+        """Build a one segment index with a sorted vocabulary.
+
+        terms[i] is the term (word or biword tuple) with term id i in the
+        parallel (term id, doc id, tf) arrays, which can be in any order,
+        as can the position gaps of each posting if given.
+        """
+        keys = np.array([encode_term(term) for term in terms],
+                        dtype=np.string_)
+        order = np.argsort(keys, kind='mergesort')
+        rank = np.empty(len(keys), dtype=np.int64)
+        rank[order] = np.arange(len(keys))
+        segment = Segment.from_triples(rank[term_ids], doc_ids, tfs,
+                                       len(keys), positions)
+        return cls(keys[order], [segment])
+
+    def term_id(self, term):
+        """Id of term in the vocabulary, or -1 if not indexed."""
+        i = find_term(self.terms, term)
+        if i < 0:
+            return self.added.get(encode_term(term), -1)
+        return i
+
+    def add_term(self, term):
+        """Id of term, adding it to the vocabulary if it is new."""
+        i = self.term_id(term)
+        if i < 0:
+            i = len(self)
+            key = encode_term(term)
+            self.added[key] = i
+            self.added_terms.append(key)
+        return i
+
+    def term(self, term_id):
+        if term_id < len(self.terms):
+            return decode_term(self.terms[term_id])
+        return decode_term(self.added_terms[term_id - len(self.terms)])
+
+    def add_postings(self, doc_id, term_freqs, term_positions=None):
+        """Buffer the (term id, tf) pairs of one new doc.
+
+        A positional index also takes the sorted positions of each pair.
+        """
+        for i, (term_id, freq) in enumerate(term_freqs):
+            if term_id not in self.buffer:
+                self.buffer[term_id] = (array('i'), array('i'),
+                                        array('i'))
+            docs, tfs, gaps = self.buffer[term_id]
+            docs.append(doc_id)
+            tfs.append(freq)
+            if self.positional:
+                positions = term_positions[i]
+                gaps.append(positions[0])
+                gaps.extend(b - a for (a, b) in zip(positions,
+                                                    positions[1:]))
+        self.buffered_docs += 1
+
+    def buffer_segment(self):
+        """The write buffer's postings as a segment."""
+        term_ids = list()
+        doc_ids = array('i')
+        tfs = array('i')
+        positions = array('i')
+        for term_id, (docs, freqs, gaps) in self.buffer.items():
+            term_ids.append(np.repeat(term_id, len(docs)))
+            doc_ids.extend(docs)
+            tfs.extend(freqs)
+            positions.extend(gaps)
+        if term_ids:
+            term_ids = np.concatenate(term_ids)
+        else:
+            term_ids = np.zeros(0, dtype=np.int64)
+        if self.positional:
+            positions = np.frombuffer(positions, dtype=np.intc).copy()
+        else:
+            positions = None
+        return Segment.from_triples(
+            term_ids, np.frombuffer(doc_ids, dtype=np.intc).copy(),
+            np.frombuffer(tfs, dtype=np.intc).copy(), len(self), positions)
+
+    def flush(self):
+        """Turn the write buffer into a new segment."""
+        if self.buffered_docs:
+            segment = self.buffer_segment()
+            self.buffer = {}
+            self.buffered_docs = 0
+            self.segments = self.segments + [segment]
+
+    def all_segments(self):
+        """Every segment, including the write buffer if it holds docs."""
+        if self.buffered_docs:
+            return self.segments + [self.buffer_segment()]
+        return self.segments
+
+    def merged(self, keep=None):
+        """All postings as one segment, dropping docs where keep is False."""
+        segments = self.all_segments()
+        if len(segments) == 1 and keep is None:
+            return segments[0]
+        return Segment.merge(segments, len(self), keep)
+
+    def compacted(self, keep=None):
+        """One segment copy with the whole vocabulary sorted.
+
+        Returns (index, order), where term id i of the copy was term id
+        order[i] here.
+        """
+        keys = np.concatenate([self.terms, np.array(self.added_terms,
+                                                    dtype=np.string_)])
+        order = np.argsort(keys, kind='mergesort')
+        rank = np.empty(len(keys), dtype=np.int64)
+        rank[order] = np.arange(len(keys))
+        merged = self.merged(keep)
+        segment = Segment.from_triples(rank[merged.term_ids()],
+                                       merged.doc_ids, merged.tfs,
+                                       len(keys), merged.positions)
+        return InvertedIndex(keys[order], [segment]), order
+
+    def blocks(self, term_id):
+        """Skip list of one term's postings over every segment.
+
+        Returns the last doc id of each block, in doc order, and the
+        (segment, segment term id, block) to decode each by.
+        """
+        segments = [(segment, term_id) for segment in self.segments]
+        if term_id in self.buffer:
+            docs, tfs, gaps = self.buffer[term_id]
+            segments.append((Segment(
+                np.array([0, len(docs)]), np.frombuffer(docs, dtype=np.intc),
+                np.frombuffer(tfs, dtype=np.intc)), 0))
+        lasts = list()
+        refs = list()
+        for segment, seg_term_id in segments:
+            seg_lasts = segment.blocks(seg_term_id).tolist()
+            lasts.extend(seg_lasts)
+            refs.extend((segment, seg_term_id, b)
+                        for b in range(len(seg_lasts)))
+        return lasts, refs
+
+    def postings(self, term_id):
+        """Doc ids and term frequencies of one term, in doc order."""
+        parts = [seg.postings(term_id) for seg in self.segments]
+        if term_id in self.buffer:
+            docs, tfs, gaps = self.buffer[term_id]
+            parts.append((np.frombuffer(docs, dtype=np.intc).copy(),
+                          np.frombuffer(tfs, dtype=np.intc).copy()))
+        if len(parts) == 1:
+            return parts[0]
+        return (np.concatenate([docs for (docs, tfs) in parts]),
+                np.concatenate([tfs for (docs, tfs) in parts]))
+
+    def term_positions(self, term_id, docs=None):
+        """Doc ids, position counts and positions of one term, in doc order.
+
+        Only the postings of docs, a sorted array, are decoded if given.
+        """
+        parts = [segment.term_positions(term_id, docs)
+                 for segment in self.all_segments()]
+        if len(parts) == 1:
+            return parts[0]
+        return tuple(np.concatenate([part[i] for part in parts])
+                     for i in range(3))
+
+    def __len__(self):
+        return len(self.terms) + len(self.added_terms)
+
+    def __contains__(self, term):
+        return self.term_id(term) >= 0
+
+    def __iter__(self):
+        for term_id in range(len(self)):
+            yield self.term(term_id)
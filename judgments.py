@@ -0,0 +1,171 @@
+import os
+import re
+
+import numpy as np
+import pandas as pd
+
+from index import write_arrays, read_arrays
+
+# insert qrels and topics files here
+QRELS = 'qrels.february'
+TOPICS = '06.topics.851-900.txt'
+
+# binary cache written beside the qrels file
+CACHE_SUFFIX = '.judgments'
+
+# judgments already loaded in this process, by source files
+_loaded = {}
+
+
+def _file_key(path):
+    # changes whenever the file is rewritten
+    info = os.stat(path)
+    return [os.path.abspath(path), info.st_size, info.st_mtime]
+
+
+class Judgments(object):
+    """Topic titles and graded relevance judgments, parsed once.
+
+    Judgments are held per topic like postings: the judged blog ids of
+    topic_ids[i] are blog_ids[offsets[i]:offsets[i + 1]], sorted, with
+    their grades (0 for not relevant) in grades. The titles of the topics
+    in the topic file are titles, by query_ids.
+    """
+
+    def __init__(self, query_ids, titles, topic_ids, offsets, blog_ids,
+                 grades):
+        self.query_ids = query_ids
+        self.titles = titles
+        self.topic_ids = topic_ids
+        self.offsets = offsets
+        self.blog_ids = blog_ids
+        self.grades = grades
+
+    @classmethod
+    def parse(cls, relevant_file=QRELS, topic_file=TOPICS):
+        """Parse a topic file and a qrels file."""
+        topics = open(topic_file).read()
+        queries = re.findall(r'<num> Number: (\d+)\n\n<title> '
+                             '([\"\w+\s+\d+\??]+)\s\s<desc>', topics)
+        queries = sorted((query[0].rstrip(), query[1]) for query in queries)
+
+        # QRELS format:
+        # 851 0 BLOG06-20060201-000-0021156117 0
+        judged = list()
+        for line in open(relevant_file):
+            data = line.split()
+            if data:
+                judged.append((data[0], data[2], int(data[3])))
+        judged.sort()
+        topics = np.array([topic_id for (topic_id, b, g) in judged],
+                          dtype=np.string_)
+        topic_ids = np.unique(topics)
+        offsets = np.append(np.searchsorted(topics, topic_ids), len(topics))
+        return cls(np.array([query_id for (query_id, title) in queries],
+                            dtype=np.string_),
+                   np.array([title for (query_id, title) in queries],
+                            dtype=np.string_),
+                   topic_ids, offsets.astype(np.int64),
+                   np.array([blog_id for (t, blog_id, g) in judged],
+                            dtype=np.string_),
+                   np.array([grade for (t, b, grade) in judged],
+                            dtype=np.int8))
+
+    @classmethod
+    def load(cls, relevant_file=QRELS, topic_file=TOPICS, cache_path=None):
+        """Judgments for a qrels and topic file, parsed at most once.
+
+        The parsed judgments are kept for the rest of the process and in a
+        binary file at cache_path (the qrels path plus .judgments by
+        default), which is reused until either source file changes.
+        cache_path False turns the file off.
+        """
+        source = {'qrels': _file_key(relevant_file),
+                  'topics': _file_key(topic_file)}
+        key = repr(sorted(source.items()))
+        if key in _loaded:
+            return _loaded[key]
+
+        if cache_path is None:
+            cache_path = relevant_file + CACHE_SUFFIX
+        self = None
+        if cache_path and os.path.exists(cache_path):
+            try:
+                arrays, meta = read_arrays(cache_path, use_mmap=False)
+                if meta.get('source') == source:
+                    self = cls(arrays['query_ids'], arrays['titles'],
+                               arrays['topic_ids'], arrays['offsets'],
+                               arrays['blog_ids'], arrays['grades'])
+            except Exception:
+                # unreadable, parsed again below
+                self = None
+        if self is None:
+            self = cls.parse(relevant_file, topic_file)
+            if cache_path:
+                try:
+                    self.save(cache_path, {'source': source})
+                except (IOError, OSError):
+                    pass
+        _loaded[key] = self
+        return self
+
+    def save(self, path, meta=None):
+        write_arrays(path, {
+            'query_ids': self.query_ids,
+            'titles': self.titles,
+            'topic_ids': self.topic_ids,
+            'offsets': self.offsets,
+            'blog_ids': self.blog_ids,
+            'grades': self.grades
+        }, meta or {})
+
+    def queries(self):
+        """Topic titles by topic number."""
+        return dict(zip(self.query_ids.tolist(), self.titles.tolist()))
+
+    def judged(self, topic_id):
+        """Judged blog ids of a topic, and their grades."""
+        i = np.searchsorted(self.topic_ids, topic_id)
+        if i == len(self.topic_ids) or self.topic_ids[i] != topic_id:
+            return self.blog_ids[:0], self.grades[:0]
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return self.blog_ids[start:end], self.grades[start:end]
+
+    def relevant(self, topic_id, min_grade=1):
+        """Blog ids of a topic judged at least min_grade."""
+        blog_ids, grades = self.judged(topic_id)
+        return blog_ids[grades >= min_grade]
+
+    def doc_ids(self, search_engine):
+        """Doc id of every judged blog id in search_engine, 0 if absent."""
+        ids = search_engine.blog_ids['id']
+        ids = ids[~ids.duplicated()]
+        doc_ids = pd.Series(ids.index, index=ids.values)
+        return doc_ids.reindex(self.blog_ids).fillna(0).values.astype(
+            np.int64)
+
+    def relevant_docs(self, search_engine, min_grade=1):
+        """Doc ids judged at least min_grade, by topic, sorted.
+
+        Only docs search_engine holds text for count, so blank and
+        deleted docs are left out. Every judged topic has an entry.
+        """
+        docs = self.doc_ids(search_engine)
+        live = np.zeros(len(search_engine.blog_ids) + 1, dtype=bool)
+        live[search_engine.blog_ids.index.values] = True
+        live[search_engine.blank_docs] = False
+        live[0] = False
+        if search_engine.num_deleted:
+            live[:len(search_engine.deleted)] &= ~search_engine.deleted[
+                :len(live)]
+        keep = live[docs] & (self.grades >= min_grade)
+        return dict((topic_id, np.sort(docs[start:end][keep[start:end]]))
+                    for (topic_id, start, end) in zip(
+                        self.topic_ids.tolist(), self.offsets[:-1],
+                        self.offsets[1:]))
+
+    def relevant_counts(self, search_engine, min_grade=1):
+        """Number of topics each doc id is judged at least min_grade for."""
+        docs = self.doc_ids(search_engine)
+        docs = docs[(docs > 0) & (self.grades >= min_grade)]
+        return np.bincount(docs, minlength=len(search_engine.blog_ids) + 1)
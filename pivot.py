@@ -1,49 +1,42 @@
+import numpy as np
 import pandas as pd
-import re
+from itertools import product
+from multiprocessing import Pool
 
 from scipy.stats import linregress
 from numpy.linalg import solve
 
-# insert qrels and topics files here
-QRELS = 'qrels.february'
-TOPICS = '06.topics.851-900.txt'
+from search import pivoted_lengths, top_k_rows
+from judgments import Judgments, QRELS, TOPICS
 
+# the tuner being run, inherited by forked pool workers
+_tuner = None
 
-def find_pivot(search_engine, k, num_bins):
+
+def find_pivot(search_engine, k, num_bins, judgments=None):
 
     if not search_engine.normalize:
         raise Exception('Error: Can only pivot with normalized weights.')
+    if judgments is None:
+        judgments = Judgments.load()
 
     retrieved = dict([(blog_id, 0)
                       for blog_id in search_engine.blog_ids['id']])
-    relevant = dict([(blog_id, 0)
-                     for blog_id in search_engine.blog_ids['id']])
 
     # build dict of document: # retrieved
-    topics = open(TOPICS).read()
-    queries = re.findall(r'<num> Number: (\d+)\n\n<title> ([\"\w+\s+\d+\??]+)'
-                         '\s\s<desc>', topics)
-    queries = dict([(query[0].rstrip(), query[1]) for query in queries])
-    for query_id in queries.keys():
-        results = search_engine.query(queries[query_id], k)
+    queries = judgments.queries()
+    for results in search_engine.query_batch(queries.values(), k):
         for blog_id in results['id']:
             retrieved[blog_id] += 1
 
-    # build dict of document: # of relevant
-    for line in open(QRELS):
-        try:
-            data = line.split()
-            blog_id = data[2]
-            if int(data[3]) > 0:
-                relevant[blog_id] += 1
-        # doc not found!
-        except KeyError:
-            pass
+    # number of topics each doc is relevant to, by doc id
+    relevant = judgments.relevant_counts(search_engine)
 
     # turn the document lengths into bins, and calculate medians of those bins
-    zipped_lengths = zip(*search_engine.doc_lengths.items())
-    length_df = pd.DataFrame(list(zipped_lengths[1]),
-                             index=list(zipped_lengths[0]),
+    doc_lengths = search_engine.doc_lengths
+    indexed = np.flatnonzero(doc_lengths)
+    length_df = pd.DataFrame(doc_lengths[indexed],
+                             index=indexed,
                              columns=['length'])
 
     length_df['length_binned'] = pd.qcut(length_df['length'], num_bins)
@@ -63,14 +56,10 @@ def find_pivot(search_engine, k, num_bins):
     retrieved_df = pd.merge(search_engine.blog_ids,
                             retrieved_df, left_on='id', right_index=True)
 
-    # build df from relevant documents joining w/ integer blog index
-    zipped_relevant = zip(*relevant.items())
-    relevant_df = pd.DataFrame(list(zipped_relevant[1]),
-                               index=list(zipped_relevant[0]),
+    # build df from relevant documents w/ integer blog index
+    relevant_df = pd.DataFrame(relevant[search_engine.blog_ids.index],
+                               index=search_engine.blog_ids.index,
                                columns=['relevant'])
-    relevant_df = pd.merge(search_engine.blog_ids,
-                           relevant_df,
-                           left_on='id', right_index=True)
 
     # merge these into one table - bins and retrieved/relevant
     merged = length_df.join(relevant_df['relevant']).join(
@@ -90,3 +79,105 @@ def find_pivot(search_engine, k, num_bins):
     solved = solve([[ret_s, -1], [rel_s, -1]], [-ret_i, -rel_i])
 
     print 'Pivot factor: {}'.format(solved[0])
+
+
+def _score_setting(setting):
+    return _tuner.score(*setting)
+
+
+class PivotTuner(object):
+    """Sweep pivoted normalization parameters over the topic set.
+
+    Every doc's weights share one divisor, so a pivoted score is the raw
+    tf-idf score divided by the doc's pivoted length. The topics are scored
+    against the raw weights once, and each (slope, pivot) setting only
+    rescales those scores, leaving the engine's own weights untouched.
+
+    Rankings are cut at k without padding, so MAP is over the docs that
+    match a query term.
+    """
+
+    def __init__(self, search_engine, k=1000, workers=1,
+                 relevant_file=QRELS, topic_file=TOPICS, judgments=None):
+        if not search_engine.normalize:
+            raise Exception('Error: Can only pivot with normalized weights.')
+        self.search_engine = search_engine
+        self.k = k
+        self.workers = workers
+        self.doc_lengths = search_engine.doc_lengths
+
+        # only docs we actually have text for can be relevant
+        if judgments is None:
+            judgments = Judgments.load(relevant_file, topic_file)
+        queries = judgments.queries()
+        qrels = judgments.relevant_docs(search_engine)
+        self.query_ids = list()
+        relevant = list()
+        for query_id in sorted(queries):
+            docs = qrels.get(query_id, ())
+            if len(docs):
+                self.query_ids.append(query_id)
+                relevant.append(docs)
+        self.num_relevant = np.array([len(docs) for docs in relevant],
+                                     dtype=np.float64)
+        # (row, doc) pairs of relevant docs as single sorted keys
+        self.num_cols = len(self.doc_lengths)
+        self.relevant = np.sort(np.concatenate(
+            [row * self.num_cols + np.array(docs, dtype=np.int64)
+             for row, docs in enumerate(relevant)] or [[]]).astype(np.int64))
+
+        # unnormalized scores of every topic, computed once
+        engine = search_engine
+        self.scores = engine.query_matrix(
+            [engine.parse_query(queries[query_id])
+             for query_id in self.query_ids]) * engine.term_doc_matrix()
+        self.results = None
+        self.best = None
+
+    def score(self, slope, pivot_factor):
+        """MAP and P@10 of the topics under one pivot setting."""
+        scores = self.scores.copy()
+        scores.data /= pivoted_lengths(self.doc_lengths, slope,
+                                       pivot_factor)[scores.indices]
+        hits = np.zeros((len(self.query_ids), self.k), dtype=bool)
+        for row, (docs, top_scores) in enumerate(top_k_rows(scores,
+                                                            self.k)):
+            keys = row * self.num_cols + docs.astype(np.int64)
+            hits[row, :len(docs)] = np.in1d(keys, self.relevant)
+        cum_hits = np.cumsum(hits, axis=1)
+        precisions = cum_hits / np.arange(1.0, self.k + 1)
+        ap = (precisions * hits).sum(axis=1) / self.num_relevant
+        p10 = cum_hits[:, min(10, self.k) - 1] / 10.0
+        return ap.mean(), p10.mean()
+
+    def run(self, slopes, pivot_factors):
+        """Score every (slope, pivot) pair of the grid.
+
+        Returns a DataFrame of MAP and P@10 per setting, best first, and
+        keeps the best (slope, pivot_factor) in self.best.
+        """
+        global _tuner
+        settings = list(product(slopes, pivot_factors))
+        _tuner = self
+        try:
+            if self.workers > 1:
+                pool = Pool(self.workers)
+                metrics = pool.map(_score_setting, settings)
+                pool.close()
+                pool.join()
+            else:
+                metrics = map(_score_setting, settings)
+        finally:
+            _tuner = None
+
+        results = pd.DataFrame([setting + metric for (setting, metric)
+                                in zip(settings, metrics)],
+                               columns=['slope', 'pivot', 'MAP', 'P@10'])
+        # stable, so ties go to the earlier setting
+        self.results = results.sort_values(
+            ['MAP', 'P@10'], ascending=False, kind='mergesort')
+        best = self.results.iloc[0]
+        self.best = (best['slope'], best['pivot'])
+        print 'Best slope: {}, pivot factor: {}, MAP: {}'.format(
+            best['slope'], best['pivot'], best['MAP'])
+        return self.results
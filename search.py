@@ -1,13 +1,258 @@
-import os
-import gc
+import re
+import time
+import bisect
+import heapq
+import functools
 import random
+import threading
+from array import array
+from multiprocessing import Pool
 
 import nltk
-from nltk.corpus import stopwords as sw
 import numpy as np
 import pandas as pd
+from scipy import sparse
 
-from tokenizer import tokens
+from tokenizer import Analyzer, english_stopwords
+from index import (InvertedIndex, Segment, CompressedSegment,
+                   ImpactSegment, ForwardIndex, IMPACT_BITS, read_arrays,
+                   write_arrays)
+from cache import ResultCache
+from stats import Stats
+from sources import DirectorySource, file_blog_id, read_document
+
+# chunks handed to each build worker, to even out uneven document sizes
+CHUNKS_PER_WORKER = 4
+
+# docs held in the write buffer before it becomes a segment
+BUFFER_DOCS = 1000
+
+# segments kept before adjacent ones are merged in the background
+MAX_SEGMENTS = 8
+
+# pseudo-relevance feedback: top docs read, terms added, and the share of
+# the expanded query left to the original terms
+FEEDBACK_DOCS = 10
+FEEDBACK_TERMS = 20
+ORIGINAL_WEIGHT = 0.5
+
+
+def _index_document(doc, analyzer, biwords, english_only, positions, stats):
+    """Count the terms of one non-empty document, in one tokenizing pass.
+
+    Returns the frequency dicts to add to the postings, which is empty if
+    the document is filtered out as non-English, and with positions the
+    sorted positions of each word, or None.
+    """
+    # language detection looks at stopwords, even when they are dropped
+    all_tokens = list() if english_only and analyzer.stop else None
+    term_positions = None
+    if positions or all_tokens is not None:
+        with stats.timer('tokenize'):
+            pairs = list(analyzer.iter_positions(doc, all_tokens))
+            words = [word for (position, word) in pairs]
+        with stats.timer('count'):
+            fd = dict(nltk.FreqDist(words))
+            if positions:
+                term_positions = {}
+                for position, word in pairs:
+                    if word in term_positions:
+                        term_positions[word].append(position)
+                    else:
+                        term_positions[word] = [position]
+        stats.count('tokens', len(words))
+    elif biwords or stats.enabled:
+        # tokenized and counted apart, which also times them apart
+        with stats.timer('tokenize'):
+            words = analyzer.tokens(doc)
+        with stats.timer('count'):
+            fd = dict(nltk.FreqDist(words))
+        stats.count('tokens', len(words))
+    else:
+        # count straight off the token stream
+        fd = dict(nltk.FreqDist(analyzer.iter_tokens(doc)))
+
+    if english_only:
+        with stats.timer('english_check'):
+            top_words = list()
+            if all_tokens is None:
+                top_words = sorted(fd.keys(), key=fd.get)[-3:]
+
+            # if want to check english but NOT keep stopwords:
+            # i.e. if using bigrams
+            else:
+                # count again with the stopwords the tokens kept
+                fd_with_stop = dict(nltk.FreqDist(all_tokens))
+                top_words = sorted(fd_with_stop.keys(),
+                                   key=fd_with_stop.get)[-3:]
+
+            filtered = [word for word in top_words
+                        if word in english_stopwords()]
+            if len(filtered) < 2:
+                return [], None
+
+    if not fd:
+        return [], None
+
+    fds = [fd]
+    if biwords:
+        # store common bi-word phrases
+        with stats.timer('bigrams'):
+            bigram_fd = dict(nltk.FreqDist(nltk.bigrams(words)))
+            top_3_bigrams = sorted(
+                bigram_fd.keys(), key=bigram_fd.get)[-3:]
+            top_fd = dict([(k, v) for (k, v) in bigram_fd.items()
+                           if k in top_3_bigrams and v > 1])
+        fds.append(top_fd)
+    return fds, term_positions
+
+
+def _index_parts(args, analyzer=None):
+    """Build the postings segment of a run of source parts.
+
+    args is (parts, options). Docs are streamed from the source and their
+    text dropped once counted. Doc ids are numbered from 1 within the run,
+    and _merge_segments shifts them after the runs before it. Postings
+    come back as parallel (term id, doc id, tf) arrays over the segment's
+    own term list, with the run's Stats. Worker processes compile their
+    own analyzer.
+    """
+    parts, options = args
+    stats = Stats(options['stats'])
+    source = options['source']
+    tokenization = options['tokenization']
+    if analyzer is None:
+        analyzer = Analyzer(**tokenization)
+
+    vocab = {}
+    term_ids = array('i')
+    doc_ids = array('i')
+    tfs = array('i')
+    positions = array('i')
+    blank_docs = list()
+    blog_ids = list()
+    for part in parts:
+        for blog_id, doc in stats.timed('read', source.read(part)):
+            blog_ids.append(blog_id)
+            id_num = len(blog_ids)
+
+            # skip empty docs!
+            if doc:
+                fds, term_positions = _index_document(
+                    doc, analyzer, options['biwords'],
+                    options['english_only'], options['positions'], stats)
+                for fd in fds:
+                    for word, freq in fd.items():
+                        if word not in vocab:
+                            vocab[word] = len(vocab)
+                        term_ids.append(vocab[word])
+                        doc_ids.append(id_num)
+                        tfs.append(freq)
+                        if term_positions is not None:
+                            # first position, then the gaps
+                            word_positions = term_positions[word]
+                            positions.append(word_positions[0])
+                            positions.extend(
+                                b - a for (a, b) in zip(word_positions,
+                                                        word_positions[1:]))
+
+            # deal with any blank docs
+            else:
+                blank_docs.append(id_num)
+
+    stats.count('docs_read', len(blog_ids))
+    stats.count('blank_docs', len(blank_docs))
+    stats.count('postings', len(term_ids))
+    terms = sorted(vocab.keys(), key=vocab.get)
+    if options['positions']:
+        positions = np.frombuffer(positions, dtype=np.intc)
+    else:
+        positions = None
+    return (terms, np.frombuffer(term_ids, dtype=np.intc),
+            np.frombuffer(doc_ids, dtype=np.intc),
+            np.frombuffer(tfs, dtype=np.intc), positions, blank_docs,
+            blog_ids, stats)
+
+
+def _merge_segments(segments, stats):
+    """Merge segments from _index_parts, in doc order, into one index.
+
+    Returns the index, blank doc ids and blog ids in doc id order. The
+    segments' stats are added to stats.
+    """
+    vocab = {}
+    term_ids = list()
+    doc_ids = list()
+    tfs = list()
+    positions = list()
+    blank_docs = list()
+    blog_ids = list()
+    for (terms, seg_term_ids, seg_doc_ids, seg_tfs, seg_positions, seg_blank,
+         seg_blog_ids, seg_stats) in segments:
+        stats.merge(seg_stats)
+        # map segment term and doc ids onto ids over all segments
+        mapping = np.array([vocab.setdefault(term, len(vocab))
+                            for term in terms], dtype=np.int64)
+        term_ids.append(mapping[seg_term_ids])
+        doc_ids.append(seg_doc_ids + len(blog_ids))
+        tfs.append(seg_tfs)
+        if seg_positions is not None:
+            positions.append(seg_positions)
+        blank_docs.extend(doc + len(blog_ids) for doc in seg_blank)
+        blog_ids.extend(seg_blog_ids)
+
+    terms = sorted(vocab.keys(), key=vocab.get)
+    with stats.timer('merge'):
+        index = InvertedIndex.from_triples(
+            terms, np.concatenate(term_ids), np.concatenate(doc_ids),
+            np.concatenate(tfs),
+            positions=np.concatenate(positions) if positions else None)
+    stats.count('terms', len(terms))
+    return index, blank_docs, blog_ids
+
+
+def top_k(docs, scores, k):
+    """The k highest scores, best first, with ties going to the lower doc.
+
+    >>> docs, scores = np.array([3, 1, 2]), np.array([0.5, 2.0, 0.5])
+    >>> [found.tolist() for found in top_k(docs, scores, 2)]
+    [[1, 2], [2.0, 0.5]]
+    >>> [found.tolist() for found in top_k(docs, scores, 0)]
+    [[], []]
+    """
+    if k < 1:
+        return docs[:0], scores[:0]
+    if len(docs) > k:
+        # keep everything at least as good as the kth best score
+        kth = np.partition(scores, len(scores) - k)[len(scores) - k]
+        keep = scores >= kth
+        docs, scores = docs[keep], scores[keep]
+    order = np.lexsort((docs, -scores))[:k]
+    return docs[order], scores[order]
+
+
+def top_k_rows(scores, k):
+    """top_k of every row of a sparse score matrix, as (docs, scores)."""
+    # sort every row by score at once, then keep the first k of each
+    num_rows = scores.shape[0]
+    row_ids = np.repeat(np.arange(num_rows), np.diff(scores.indptr))
+    order = np.lexsort((scores.indices, -scores.data, row_ids))
+    rank = np.arange(len(order)) - scores.indptr[row_ids[order]]
+    order = order[rank < k]
+    bounds = np.searchsorted(row_ids[order], np.arange(num_rows + 1))
+    return [(scores.indices[order[bounds[row]:bounds[row + 1]]],
+             scores.data[order[bounds[row]:bounds[row + 1]]])
+            for row in range(num_rows)]
+
+
+def _whole_list(docs, weights, ref):
+    # a list read whole, as its only block
+    return docs, weights
+
+
+def pivoted_lengths(doc_lengths, slope, pivot_factor):
+    """Pivoted normalization divisors for docs of the given lengths."""
+    return ((1.0 - slope) * pivot_factor) + (slope * doc_lengths)
 
 
 class SearchEngine(object):
@@ -16,9 +261,78 @@ class SearchEngine(object):
                  biwords=False, english_only=False, corpus_dir='corpus/',
 
                  lowercase=True, tokenize='no_digits', stopwords=True,
-                 stemming=None, lemmatize=False):
+                 stemming=None, lemmatize=False, workers=1, source=None,
+                 cache_size=0, cache_bytes=None, stats=None, positions=False):
 
         # set shared options
+        self.configure(normalize, biwords, english_only, corpus_dir,
+                       lowercase, tokenize, stopwords, stemming, lemmatize,
+                       cache_size, cache_bytes, stats, positions)
+
+        # load collection, as parts (files or bundles) read lazily
+        if source is None:
+            source = DirectorySource(corpus_dir)
+        parts = source.parts()
+
+        if sample:
+            # a sample of parts is only a sample of docs when each part is
+            # a single doc
+            if not getattr(source, 'single_doc_parts', False):
+                raise Exception('Error: can only sample a source of single '
+                                'document files, pass sample=False.')
+            parts = random.sample(parts, min(docs, len(parts)))
+
+        with self.stats.profile('build'), self.stats.timer('build'):
+            options = {
+                'source': source,
+                'tokenization': self.tokenization,
+                'biwords': self.biwords,
+                'english_only': english_only,
+                'positions': self.positions,
+                'stats': self.stats.enabled
+            }
+            if workers > 1:
+                # contiguous chunks merged in order keep doc ids and postings
+                # order identical to a serial build
+                size = max(1, -(-len(parts) // (workers * CHUNKS_PER_WORKER)))
+                chunks = [(parts[first:first + size], options)
+                          for first in range(0, len(parts), size)]
+                pool = Pool(workers)
+                index, blank_docs, blog_ids = _merge_segments(
+                    pool.imap(_index_parts, chunks), self.stats)
+                pool.close()
+                pool.join()
+            else:
+                index, blank_docs, blog_ids = _merge_segments(
+                    [_index_parts((parts, options), self.analyzer)],
+                    self.stats)
+
+            self.set_index(index, blank_docs, blog_ids)
+
+    @classmethod
+    def from_index(cls, index, blank_docs, blog_ids, **options):
+        """An engine over an InvertedIndex built elsewhere.
+
+        blank_docs and blog_ids are as for set_index, and options are the
+        keyword options of SearchEngine that do not read documents. The
+        tokenization options should be the ones the index was built with,
+        as queries are tokenized with them.
+        """
+        self = cls.__new__(cls)
+        self.configure(**options)
+        with self.stats.timer('build'):
+            self.set_index(index, blank_docs, blog_ids)
+        return self
+
+    def configure(self, normalize=False, biwords=False, english_only=False,
+                  corpus_dir='corpus/', lowercase=True, tokenize='no_digits',
+                  stopwords=True, stemming=None, lemmatize=False,
+                  cache_size=0, cache_bytes=None, stats=None,
+                  positions=False):
+        if biwords and positions:
+            print ('Error: can only choose one of biwords or positions. '
+                   'Choosing positions')
+            biwords = False
         if biwords:
             stopwords = False
 
@@ -29,173 +343,1152 @@ class SearchEngine(object):
             'stemming': stemming,
             'lemmatize': lemmatize
         }
+        self.analyzer = Analyzer(**self.tokenization)
         self.biwords = biwords
+        # positions of every posting, for "quoted phrase" queries
+        self.positions = positions
         self.normalize = normalize
+        self.english_only = english_only
         self.corpus_dir = corpus_dir
 
-        # load collection
-        files = [os.path.join(root, name)
-                 for root, dirs, files in os.walk(
-                 corpus_dir, topdown=True) for name in files]
+        # per stage timings and counters, disabled unless passed in
+        self.stats = stats if stats is not None else Stats()
 
-        collection = list()
-        blog_ids = list()
+        # optional cache of ranked results, cleared when weights change
+        self.cache = None
+        if cache_size:
+            self.cache = ResultCache(cache_size, cache_bytes)
 
-        if sample:
-            files = random.sample(files, docs)
-
-        for filename in files:
-            f = open(filename)
-            collection.append(f.read())
-            blog_ids.append(filename.split('/')[1].split('.')[0])
-            f.close()
-
-        # lookup of blog id's
-        self.blog_ids = pd.DataFrame(blog_ids,
-                                     index=range(1, len(blog_ids) + 1),
-                                     columns=['id'])
-
-        # build data structure
-        self.postings = {}
-        self.weights = {}
-        self.doc_lengths = {}
-        self.normalized = {}
-        self.blank_docs = list()
-
-        # for cheap language detection
-        stop = sw.words('english')
-
-        id_num = 1
-        for doc in collection:
-            # skip empty docs!
-            if doc:
-                words = tokens(doc, **self.tokenization)
-                fd = dict(nltk.FreqDist(words))
-
-                if english_only:
-
-                    top_words = list()
-                    if stopwords:
-                        top_words = sorted(fd.keys(), key=fd.get)[-3:]
-
-                    # if want to check english but NOT keep stopwords:
-                    # i.e. if using bigrams
-                    elif not stopwords:
-                        # reset parse options - pretend we will keep stopwords
-                        stopwords = True
-                        words_with_stop = tokens(doc, **self.tokenization)
-                        # need to RECALCULATE the FD
-                        fd_with_stop = dict(nltk.FreqDist(words_with_stop))
-                        top_words = sorted(fd.keys(),
-                                           key=fd_with_stop.get)[-3:]
-
-                    filtered = [word for word in top_words if word in stop]
-                    if len(filtered) < 2:
-                        words = None
-
-                if words:
-                    self.add_to_postings(fd, id_num)
-
-                if words and biwords:
-                    # store common bi-word phrases
-                    bigram_fd = dict(nltk.FreqDist(nltk.bigrams(words)))
-                    top_3_bigrams = sorted(
-                        bigram_fd.keys(), key=bigram_fd.get)[-3:]
-                    top_fd = dict([(k, v) for (k, v) in bigram_fd.items()
-                                   if k in top_3_bigrams and v > 1])
-                    self.add_to_postings(top_fd, id_num)
+    def set_index(self, index, blank_docs, blog_ids):
+        """Weight a built index of the docs with the given blog ids.
 
-            # deal with any blank docs
-            else:
-                self.blank_docs.append(id_num)
-            id_num += 1
+        Doc id i is blog_ids[i - 1], and blank_docs are the doc ids of
+        empty documents. idf counts every non-blank doc.
+        """
+        self.index = index
+        self.blank_docs = blank_docs
+
+        # lookup of blog id's, doc id i at i - 1
+        self.blog_id_list = list(blog_ids)
+        self.blog_frame = None
 
-        if not sample:
-            docs = 15948 - len(self.blank_docs)
+        docs = len(self.blog_id_list) - len(self.blank_docs)
 
         # calc TF-IDF weights
-        self.calc_weights_l(self.postings.keys(), docs)
-        if normalize:
+        self.pivot_params = None
+        self.impact_scale = None
+        self.generation = 0
+        with self.stats.timer('calc_weights'):
+            self.calc_weights_l(docs)
+        with self.stats.timer('normalize'):
             self.normalize_l()
-        else:
-            self.normalized = self.weights
+        with self.stats.timer('max_weights'):
+            self.calc_max_weights()
+        with self.stats.timer('forward'):
+            self.forward = ForwardIndex.from_segment(
+                index.merged(), len(self.blog_id_list) + 1)
+
+        # for adding and deleting documents later
+        self.deleted = np.zeros(len(self.doc_lengths), dtype=bool)
+        self.num_deleted = 0
+        self.lock = threading.RLock()
+        self.merger = None
+        self.impact_builder = None
+
+    @property
+    def blog_ids(self):
+        """Blog id of every doc, as a DataFrame indexed by doc id.
+
+        Built on first use, and again once documents have been added.
+        """
+        num_docs = len(self.blog_id_list)
+        if self.blog_frame is None or len(self.blog_frame) < num_docs:
+            self.blog_frame = pd.DataFrame(self.blog_id_list,
+                                           index=range(1, num_docs + 1),
+                                           columns=['id'])
+        return self.blog_frame
+
+    def query(self, raw_string, k=10, prune=False, feedback=False):
+        """Return the k best scoring docs for raw_string.
+
+        prune skips postings that cannot reach the top k (MaxScore), which
+        returns the same ranking while touching fewer postings. feedback,
+        'rm3' (or True) or 'rocchio', first expands the query with terms
+        from its top ranked docs.
+        """
+        stats = self.stats
+        with stats.profile('query'):
+            stats.count('queries')
+            with stats.timer('parse'):
+                query_terms = self.parse_query(raw_string)
+                phrases = self.parse_phrases(raw_string)
+            key = self.cache_key(query_terms, phrases, feedback)
+            top = None
+            if self.cache is not None:
+                top = self.cache.get(key, k)
+            if top is None:
+                if feedback:
+                    with stats.timer('feedback'):
+                        query_terms = self.expand_query(
+                            query_terms, feedback, prune, phrases)
+                with stats.timer('score'):
+                    if prune:
+                        top = self.max_score(query_terms, k, phrases)
+                    else:
+                        top = self.term_at_a_time(query_terms, k, phrases)
+                if self.cache is not None:
+                    self.cache.put(key, k, top)
+            with stats.timer('results'):
+                return self.results(top)
+
+    def query_batch(self, raw_strings, k=10):
+        """Rank many queries at once, returning one result per query.
 
-    def query(self, raw_string, k=10):
+        The queries become a sparse query x term matrix, scored against the
+        term x doc weight matrix in a single product, and any phrase
+        matches are added on. Results match query's, and share its cache.
+        """
+        stats = self.stats
+        with stats.profile('query_batch'):
+            stats.count('queries', len(raw_strings))
+            tops = [None] * len(raw_strings)
+            keys = list()
+            misses = list()
+            with stats.timer('parse'):
+                for i, raw_string in enumerate(raw_strings):
+                    query_terms = self.parse_query(raw_string)
+                    phrases = self.parse_phrases(raw_string)
+                    keys.append(self.cache_key(query_terms, phrases))
+                    if self.cache is not None:
+                        tops[i] = self.cache.get(keys[i], k)
+                    if tops[i] is None:
+                        misses.append((i, query_terms, phrases))
 
-        query_list = tokens(raw_string, **self.tokenization)
+            # score the queries the cache could not answer
+            with stats.timer('score'):
+                queries = self.query_matrix(
+                    [query_terms for (i, query_terms, p) in misses])
+                matrix = self.weight_matrix()
+                scores = queries * matrix
+                if stats.enabled:
+                    stats.count('postings_scanned', int(np.diff(
+                        matrix.indptr)[queries.indices].sum()))
+                if any(phrases for (i, q, phrases) in misses):
+                    scores = scores + self.phrase_matrix(
+                        [phrases for (i, q, phrases) in misses])
+                scores.eliminate_zeros()
+                misses = [i for (i, q, p) in misses]
+                rows = top_k_rows(scores, k)
+
+            with stats.timer('results'):
+                for i, (docs, top_scores) in zip(misses, rows):
+                    tops[i] = zip(top_scores.tolist(), docs.tolist())
+                    if self.cache is not None:
+                        self.cache.put(keys[i], k, tops[i])
+                return [self.results(top) for top in tops]
+
+    def query_budget(self, raw_string, k=10, postings=None, seconds=None):
+        """Rank raw_string within a budget of postings or of seconds.
+
+        Scores impact-ordered postings, highest weights first, and stops
+        once the budget is spent. Returns the results, as query does, and
+        a bound on how much any doc's score may fall short of its exact
+        score, 0 when the results are exact. The seconds count from the
+        call. While the impact-ordered postings are being rebuilt after
+        the weights changed, a budget of seconds is answered exactly.
+        """
+        start = time.time()
+        stats = self.stats
+        with stats.profile('query_budget'):
+            stats.count('queries')
+            with stats.timer('parse'):
+                query_terms = self.parse_query(raw_string)
+                phrases = self.parse_phrases(raw_string)
+            with stats.timer('score'):
+                if seconds is not None and self.impacts is None:
+                    # rebuilding would take far longer than such a budget
+                    self.build_impacts(background=True)
+                    top = self.term_at_a_time(query_terms, k, phrases)
+                    bound = 0.0
+                else:
+                    if seconds is not None:
+                        seconds -= time.time() - start
+                    top, bound = self.score_at_a_time(
+                        query_terms, k, postings, seconds, phrases)
+            with stats.timer('results'):
+                return self.results(top), bound
+
+    def cache_key(self, query_terms, phrases, feedback=False):
+        # what a ranking depends on, besides k and the weights
+        return tuple(sorted(query_terms.items())), phrases, feedback
+
+    def parse_query(self, raw_string):
+        """Query term frequencies by term id, ignoring unindexed terms."""
+        query_list = self.analyzer.tokens(raw_string)
         if self.biwords:
             try:
                 query_list += list(nltk.bigrams(query_list))
             except ValueError:
                 pass
+        self.stats.count('terms_looked_up', len(query_list))
 
-        df = pd.DataFrame()
+        query_terms = {}
         for word in query_list:
-            try:
-                zipped = zip(*self.normalized[word])
-                new_df = pd.DataFrame(list(zipped[1]),
-                                      index=list(zipped[0]),
-                                      columns=[word])
-                df = df.join(new_df, how='outer')
-            except KeyError:
-                # just ignore words not found
+            term_id = self.index.term_id(word)
+            if term_id >= 0:
+                query_terms[term_id] = query_terms.get(term_id, 0) + 1
+        return query_terms
+
+    def expand_query(self, query_terms, method=True, prune=False,
+                     phrases=()):
+        """Add terms from the query's top ranked docs (pseudo-relevance
+        feedback).
+
+        The query is ranked once, and the forward vectors of its top
+        FEEDBACK_DOCS docs are summed into a weight per term, either as a
+        relevance model (rm3: each doc's term probabilities, weighted by
+        its share of the scores) or as Rocchio's centroid of their unit
+        length tf-idf vectors. The FEEDBACK_TERMS best terms that are not
+        stopwords are mixed into the query, keeping ORIGINAL_WEIGHT of it
+        for the original terms. Returns the expanded query term weights.
+        """
+        if method is True:
+            method = 'rm3'
+        if method not in ('rm3', 'rocchio'):
+            raise Exception('Error: feedback is rm3 or rocchio.')
+        if prune:
+            top = self.max_score(query_terms, FEEDBACK_DOCS, phrases)
+        else:
+            top = self.term_at_a_time(query_terms, FEEDBACK_DOCS, phrases)
+        if not top:
+            return query_terms
+        scores = np.array([score for (score, doc) in top])
+        docs = np.array([doc for (score, doc) in top])
+        rows, term_ids, tfs = self.forward_index().rows(docs)
+
+        if method == 'rm3':
+            doc_tokens = np.bincount(rows, weights=tfs,
+                                     minlength=len(docs))
+            if scores.sum() > 0:
+                doc_weights = scores / scores.sum()
+            else:
+                doc_weights = np.ones(len(docs)) / len(docs)
+            weights = tfs / doc_tokens[rows] * doc_weights[rows]
+        else:
+            lengths = self.doc_lengths[docs]
+            lengths[lengths == 0] = 1.0
+            weights = (self.tf(tfs) * self.idf[term_ids] / lengths[rows] /
+                       len(docs))
+        terms, inverse = np.unique(term_ids, return_inverse=True)
+        totals = np.bincount(inverse, weights=weights)
+
+        # best terms first, leaving out stopwords and unweighted terms
+        expansion = {}
+        for i in np.argsort(-totals, kind='mergesort'):
+            if len(expansion) == FEEDBACK_TERMS or totals[i] <= 0:
+                break
+            term_id = int(terms[i])
+            if (self.idf[term_id] > 0 and
+                    self.index.term(term_id) not in english_stopwords()):
+                expansion[term_id] = totals[i]
+        self.stats.count('expansion_terms', len(expansion))
+        if not expansion:
+            return query_terms
+
+        # both parts scaled to the original query's total count
+        total = float(sum(query_terms.values()))
+        mass = sum(expansion.values())
+        expanded = dict((term_id, ORIGINAL_WEIGHT * count)
+                        for (term_id, count) in query_terms.items())
+        for term_id, weight in expansion.items():
+            expanded[term_id] = (expanded.get(term_id, 0.0) +
+                                 (1 - ORIGINAL_WEIGHT) * total * weight /
+                                 mass)
+        return expanded
+
+    def forward_index(self):
+        """Doc-major copy of the postings, for query expansion.
+
+        Built with the index, saved with it, and added to as documents
+        are added. Indexes saved without one build it on first use.
+        Deleted docs keep their rows, but are never ranked.
+        """
+        with self.lock:
+            if self.forward is None:
+                self.forward = ForwardIndex.from_segment(
+                    self.index.merged(), len(self.blog_id_list) + 1)
+        return self.forward
+
+    def parse_phrases(self, raw_string):
+        """The "quoted" phrases of a query, on a positional index.
+
+        Each phrase is a tuple of (offset, term id) pairs, the offsets
+        counting from its first word. Phrases of fewer than two indexed
+        terms, or with a term not in the index, are left out.
+        """
+        if not self.positions or '"' not in raw_string:
+            return ()
+        phrases = list()
+        for quoted in re.findall(r'"([^"]+)"', raw_string):
+            phrase = list()
+            for position, word in self.analyzer.iter_positions(quoted):
+                phrase.append((position, self.index.term_id(word)))
+            if len(phrase) < 2 or any(term_id < 0 for (p, term_id)
+                                      in phrase):
+                continue
+            first = phrase[0][0]
+            phrases.append(tuple((position - first, term_id)
+                                 for (position, term_id) in phrase))
+        self.stats.count('phrases', len(phrases))
+        return tuple(phrases)
+
+    def phrase_matches(self, phrase):
+        """Live docs holding a phrase, and how often each holds it.
+
+        Terms are intersected rarest first, and only their postings in
+        the docs still matching are decoded.
+        """
+        terms = sorted(phrase, key=lambda pair: self.df[pair[1]])
+        docs = None
+        starts = None
+        for offset, term_id in terms:
+            term_docs, counts, positions = self.index.term_positions(
+                term_id, docs)
+            self.stats.count('positions_scanned', len(positions))
+            # where the phrase would start, keyed by doc
+            keys = ((np.repeat(term_docs, counts).astype(np.int64) << 32) +
+                    positions - offset)
+            if starts is None:
+                starts = keys
+            else:
+                starts = starts[np.in1d(starts, keys)]
+            docs = np.unique(starts >> 32)
+            if not len(docs):
+                break
+        docs, counts = np.unique(starts >> 32, return_counts=True)
+        if self.num_deleted:
+            live = ~self.deleted[docs]
+            docs, counts = docs[live], counts[live]
+        return docs, counts
+
+    def phrase_weights(self, phrase):
+        """Doc ids and tf-idf weights of a phrase, scored like a term."""
+        docs, counts = self.phrase_matches(phrase)
+        idf = np.log(self.num_docs / max(len(docs), 1.0))
+        return docs, self.tf(counts) * idf / self.divisors[docs]
+
+    def phrase_matrix(self, queries):
+        """Sparse query x doc matrix of the phrase scores of each query."""
+        rows = list()
+        cols = list()
+        weights = list()
+        for row, phrases in enumerate(queries):
+            for phrase in phrases:
+                docs, phrase_weights = self.phrase_weights(phrase)
+                rows.append(np.repeat(row, len(docs)))
+                cols.append(docs)
+                weights.append(phrase_weights)
+        if not rows:
+            return sparse.csr_matrix((len(queries), len(self.divisors)))
+        return sparse.csr_matrix(
+            (np.concatenate(weights),
+             (np.concatenate(rows), np.concatenate(cols))),
+            shape=(len(queries), len(self.divisors)))
+
+    def query_matrix(self, queries):
+        """Sparse query x term matrix of parsed query term counts."""
+        rows = list()
+        cols = list()
+        counts = list()
+        for row, query_terms in enumerate(queries):
+            for term_id, count in query_terms.items():
+                rows.append(row)
+                cols.append(term_id)
+                counts.append(count)
+        return sparse.csr_matrix(
+            (np.array(counts, dtype=np.float64), (rows, cols)),
+            shape=(len(queries), len(self.index)))
+
+    def results(self, top):
+        """Ranked (score, doc) pairs as a DataFrame of relevance and id."""
+        result_df = pd.DataFrame(np.array([score for (score, doc) in top],
+                                          dtype=np.float64),
+                                 index=[doc for (score, doc) in top],
+                                 columns=['relevance'])
+        result_df['id'] = [self.blog_id_list[doc - 1]
+                           for (score, doc) in top]
+        return result_df
+
+    def term_at_a_time(self, query_terms, k, phrases=()):
+        """Score every posting of the query terms, keep the k best.
+
+        Phrases add their weights in the docs that match them. Returns a
+        list of (score, doc), best first, with ties going to the lower doc
+        id. Docs scoring 0, matching only terms in every doc, are left out.
+        """
+        scores = np.zeros(len(self.divisors))
+        for term_id, count in query_terms.items():
+            docs, weights = self.term_weights(term_id)
+            scores[docs] += count * weights
+            self.stats.count('postings_scanned', len(docs))
+        for phrase in phrases:
+            docs, weights = self.phrase_weights(phrase)
+            scores[docs] += weights
+        docs = np.flatnonzero(scores)
+        docs, scores = top_k(docs, scores[docs], k)
+        return zip(scores.tolist(), docs.tolist())
+
+    def max_score(self, query_terms, k, phrases=()):
+        """Document-at-a-time MaxScore, same results as term_at_a_time.
+
+        Terms are ordered by their largest possible contribution. Once the
+        smallest of those can no longer lift a doc into the top k on their
+        own, their lists stop producing candidates and are only probed for
+        docs found through the other lists. Lists are read a block at a
+        time, and a probe decodes only the block that could hold its doc.
+        Each phrase is matched up front and joins in as one more list.
+        """
+        if k < 1:
+            return []
+        # (bound, count, block skips, block reader) of each list, the
+        # bound being its largest possible weight, allowing for rounding
+        # when weights are quantized
+        slack = self.impact_scale or 0.0
+        sources = list()
+        for term_id, count in query_terms.items():
+            sources.append((self.max_weights[term_id] * self.idf[term_id] +
+                            slack, count, self.index.blocks(term_id),
+                            functools.partial(self.block_weights, term_id)))
+        for phrase in phrases:
+            docs, phrase_weights = self.phrase_weights(phrase)
+            if len(docs):
+                sources.append((phrase_weights.max(), 1,
+                                ([docs[-1]], [None]), functools.partial(
+                                    _whole_list, docs.tolist(),
+                                    phrase_weights.tolist())))
+        sources.sort(key=lambda source: source[1] * source[0])
+        terms = range(len(sources))
+        counts = [count for (bound, count, s, f) in sources]
+        skips = [skip for (b, c, skip, f) in sources]
+        fetches = [fetch for (b, c, s, fetch) in sources]
+        bounds = np.cumsum([bound * count for (bound, count, s, f)
+                            in sources]).tolist()
+
+        # the current block of each list, and the next block to decode
+        lists = [[] for term_id in terms]
+        weights = [[] for term_id in terms]
+        cursors = [0] * len(terms)
+        next_block = [0] * len(terms)
+        scanned = [0]
+
+        def seek(i, doc):
+            # move list i to its first posting >= doc, empty if none
+            plist = lists[i]
+            if plist and plist[-1] >= doc:
+                cursors[i] = bisect.bisect_left(plist, doc, cursors[i])
+                return
+            lasts, refs = skips[i]
+            b = bisect.bisect_left(lasts, doc, next_block[i])
+            while b < len(lasts):
+                plist, weights[i] = fetches[i](refs[b])
+                next_block[i] = b + 1
+                scanned[0] += len(plist)
+                if plist and plist[-1] >= doc:
+                    lists[i] = plist
+                    cursors[i] = bisect.bisect_left(plist, doc)
+                    return
+                b += 1
+            lists[i] = []
+            cursors[i] = 0
+
+        for i in range(len(terms)):
+            seek(i, 0)
+
+        # heap of (score, -doc), worst of the top k first
+        heap = []
+        threshold = float('-inf')
+        essential = 0
+        while essential < len(terms):
+            doc = None
+            for i in range(essential, len(terms)):
+                if cursors[i] < len(lists[i]):
+                    if doc is None or lists[i][cursors[i]] < doc:
+                        doc = lists[i][cursors[i]]
+            if doc is None:
+                break
+
+            score = 0.0
+            for i in range(essential, len(terms)):
+                plist = lists[i]
+                if cursors[i] < len(plist) and plist[cursors[i]] == doc:
+                    score += counts[i] * weights[i][cursors[i]]
+                    cursors[i] += 1
+                    if cursors[i] == len(plist):
+                        seek(i, doc + 1)
+            for i in range(essential - 1, -1, -1):
+                if score + bounds[i] <= threshold:
+                    break
+                seek(i, doc)
+                plist = lists[i]
+                if cursors[i] < len(plist) and plist[cursors[i]] == doc:
+                    score += counts[i] * weights[i][cursors[i]]
+
+            if score <= 0:
                 continue
-        score = df.sum(axis=1)
-        result_df = pd.DataFrame(score[:k]).join(self.blog_ids)
-        result_df.columns = ['relevance', 'id']
-        return result_df.sort_values('relevance', ascending=False)
+            if len(heap) < k:
+                heapq.heappush(heap, (score, -doc))
+            elif score > threshold:
+                heapq.heapreplace(heap, (score, -doc))
+            if len(heap) == k:
+                threshold = heap[0][0]
+                while (essential < len(terms) and
+                       bounds[essential] <= threshold):
+                    essential += 1
+
+        # postings decoded
+        self.stats.count('postings_scanned', scanned[0])
+        top = sorted(heap, reverse=True)
+        return [(score, -neg_doc) for (score, neg_doc) in top]
+
+    def score_at_a_time(self, query_terms, k, postings=None, seconds=None,
+                        phrases=()):
+        """Score impact bands across the query terms, best first.
+
+        Each term's postings are read a band at a time from the
+        impact-ordered segment, in descending order of the band's top
+        weight, so the largest contributions to any score come first.
+        Scoring stops before the postings budget is exceeded (a band may
+        be cut short) or once seconds have passed. Returns the top k as
+        term_at_a_time does, and the largest amount any doc's score may
+        still lack.
+        """
+        if seconds is not None:
+            deadline = time.time() + seconds
+        segment = self.impact_segment()
+        # (count, doc ids, weights, band starts) of each list
+        sources = list()
+        for term_id, count in query_terms.items():
+            if term_id < segment.num_terms:
+                sources.append((count, segment.doc_ids, segment.weights,
+                                segment.bands(term_id)))
+        for phrase in phrases:
+            docs, weights = self.phrase_weights(phrase)
+            if len(docs):
+                order = np.argsort(-weights, kind='mergesort')
+                sources.append((1, docs[order], weights[order],
+                                np.array([0, len(docs)])))
+
+        # every band, by the largest weight it can add
+        bands = sorted((-count * weights[starts[b]], i, b)
+                       for (i, (count, docs, weights, starts))
+                       in enumerate(sources)
+                       for b in range(len(starts) - 1))
+        # where each list has been read up to
+        cursors = [starts[0] for (c, d, w, starts) in sources]
+        scores = np.zeros(len(self.divisors))
+        scanned = 0
+        for (impact, i, b) in bands:
+            count, docs, weights, starts = sources[i]
+            end = starts[b + 1]
+            if postings is not None:
+                end = min(end, cursors[i] + postings - scanned)
+            if seconds is not None and time.time() > deadline:
+                break
+            band_docs = docs[cursors[i]:end]
+            scores[band_docs] += count * weights[cursors[i]:end]
+            scanned += end - cursors[i]
+            cursors[i] = end
+            if end < starts[b + 1]:
+                break
+        self.stats.count('postings_scanned', scanned)
+
+        # the weights next in line bound what each list has left to add
+        bound = sum(count * weights[cursors[i]] for (i, (count, docs,
+                    weights, starts)) in enumerate(sources)
+                    if cursors[i] < starts[-1])
+        docs = np.flatnonzero(scores)
+        docs, top_scores = top_k(docs, scores[docs], k)
+        return zip(top_scores.tolist(), docs.tolist()), float(bound)
+
+    def impact_segment(self, bits=IMPACT_BITS):
+        """Impact-ordered postings of the current weights.
+
+        Built from the weight matrix on first use and kept until the
+        weights or the documents change.
+        """
+        impacts = self.impacts
+        if impacts is None or impacts[0] != bits:
+            generation = self.generation
+            matrix = self.weight_matrix()
+            impacts = (bits, ImpactSegment.from_weights(
+                matrix.indptr, matrix.indices, matrix.data, bits))
+            with self.lock:
+                # unless the weights changed while building
+                if generation == self.generation:
+                    self.impacts = impacts
+        return impacts[1]
+
+    def build_impacts(self, background=False):
+        """Build the impact-ordered postings query_budget scores.
+
+        With background, this runs in a thread, as merge_segments does.
+        """
+        if background:
+            if (self.impact_builder is None or
+                    not self.impact_builder.is_alive()):
+                self.impact_builder = threading.Thread(
+                    target=self.impact_segment)
+                self.impact_builder.daemon = True
+                self.impact_builder.start()
+            return
+        self.impact_segment()
 
     def tf(self, num):
-        if num == 0:
-            return 0
+        # log tf, over a single count or an array of them
+        num = np.asarray(num, dtype=np.float64)
+        return np.where(num > 0, 1 + np.log(np.maximum(num, 1)), 0)
+
+    def term_weights(self, term_id):
+        """Doc ids and current tf-idf weights of one term's live postings.
+
+        Weights are derived from the stored tfs, so normalization and
+        pivoting cost nothing until a term is scored, unless the index was
+        loaded with quantized weights that are still current.
+        """
+        if self.impact_scale is not None:
+            return self.index.segments[0].impact_postings(term_id)
+        docs, tfs = self.index.postings(term_id)
+        return self.live_weights(term_id, docs, tfs)
+
+    def block_weights(self, term_id, ref):
+        """Doc ids and weights of one block from index.blocks, as lists."""
+        segment, seg_term_id, b = ref
+        if self.impact_scale is not None:
+            docs, weights = segment.impact_block(seg_term_id, b)
         else:
-            return 1 + np.log(num)
-
-    def add_to_postings(self, fd, id_num):
-        for word in fd.keys():
-            if word not in self.postings:
-                self.postings[word] = []
-            self.postings[word].append((id_num, fd[word]))
-
-    def calc_weights_l(self, word_list, docs):
-        for word in word_list:
-            # not actual frequency, just DOCUMENT frequency
-            doc_count = len(self.postings[word])
-            self.weights[word] = []
-            for (doc, freq) in self.postings[word]:
-                tfidf = self.tf(freq) * np.log(docs / float(doc_count))
-                self.weights[word].append((doc, tfidf))
-                # add to doc length record
-                if doc not in self.doc_lengths:
-                    self.doc_lengths[doc] = []
-                self.doc_lengths[doc].append(tfidf)
-        del self.postings
-        gc.collect()
+            docs, weights = self.live_weights(term_id,
+                                              *segment.block(seg_term_id, b))
+        return docs.tolist(), weights.tolist()
 
-    def normalize_l(self):
-        for doc in self.doc_lengths.keys():
-            self.doc_lengths[doc] = np.linalg.norm(self.doc_lengths[doc])
+    def live_weights(self, term_id, docs, tfs):
+        # weights of a term's postings in docs that are not deleted
+        if self.num_deleted:
+            live = ~self.deleted[docs]
+            docs, tfs = docs[live], tfs[live]
+        return docs, (self.tf(tfs) * self.idf[term_id] /
+                      self.divisors[docs])
+
+    def live_postings(self):
+        """Every live posting as one segment."""
+        if self.num_deleted:
+            return self.index.merged(~self.deleted)
+        return self.index.merged()
+
+    def weight_matrix(self):
+        """Sparse term x doc matrix of the current weights.
+
+        Built from the index on first use and kept until the weights or
+        the documents change.
+        """
+        matrix = self.matrix
+        if matrix is None:
+            generation = self.generation
+            if self.impact_scale is not None:
+                segment = self.index.segments[0]
+                matrix = sparse.csr_matrix(
+                    (segment.impacts * self.impact_scale, segment.doc_ids,
+                     segment.offsets),
+                    shape=(len(self.index), len(self.doc_lengths)))
+            else:
+                matrix = self.term_doc_matrix(self.divisors)
+            with self.lock:
+                if generation == self.generation:
+                    self.matrix = matrix
+        return matrix
+
+    def term_doc_matrix(self, divisors=None):
+        """Sparse term x doc matrix of tf-idf weights over divisors.
+
+        Without divisors the weights are left unnormalized.
+        """
+        postings = self.live_postings()
+        weights = self.tf(postings.tfs) * self.idf[postings.term_ids()]
+        if divisors is not None:
+            weights /= divisors[postings.doc_ids]
+        return sparse.csr_matrix(
+            (weights, postings.doc_ids, postings.offsets),
+            shape=(len(self.index), len(self.doc_lengths)))
+
+    def calc_weights_l(self, docs):
+        # not actual frequency, just DOCUMENT frequency
+        self.num_docs = docs
+        self.df = self.index.merged().doc_freqs()
+        self.update_idf()
+
+        # length of each doc's tf-idf vector
+        self.doc_lengths = self.calc_doc_lengths(
+            self.index.segments, len(self.blog_id_list) + 1)
+        self.calc_length_parts()
+
+    def calc_doc_lengths(self, segments, num_docs):
+        # docs never span segments, so these are their full lengths
+        lengths = np.zeros(num_docs)
+        for segment in segments:
+            tfidf = self.tf(segment.tfs) * self.idf[segment.term_ids()]
+            squares = np.bincount(segment.doc_ids, weights=tfidf ** 2,
+                                  minlength=num_docs)
+            docs = np.unique(segment.doc_ids)
+            lengths[docs] = np.sqrt(squares[docs])
+        return lengths
 
-        for word in self.weights.keys():
-            self.normalized[word] = []
-            for pair in self.weights[word]:
-                new = (pair[0], pair[1] / self.doc_lengths[pair[0]])
-                self.normalized[word].append(new)
+    def log_df(self, term_ids):
+        # log document frequency, 0 for terms no doc holds
+        return np.log(np.maximum(self.df[term_ids], 1))
+
+    def calc_length_parts(self):
+        """Per doc sums that give its length for any doc count.
+
+        With w the log tf and g the log df of each of a doc's terms, its
+        squared length is log(N) ** 2 * sum(w ** 2) - 2 * log(N) *
+        sum(w ** 2 * g) + sum(w ** 2 * g ** 2), so only docs holding a
+        term whose df changed need their sums updated.
+        """
+        parts = np.zeros((len(self.doc_lengths), 3))
+        for segment in self.index.all_segments():
+            squares = self.tf(segment.tfs) ** 2
+            log_df = self.log_df(segment.term_ids())
+            for i, weights in enumerate([squares, squares * log_df,
+                                         squares * log_df ** 2]):
+                parts[:, i] += np.bincount(segment.doc_ids, weights=weights,
+                                           minlength=len(parts))
+        self.length_parts = parts
+
+    def parts(self):
+        # the length sums, computed now if they were not loaded
+        if self.length_parts is None:
+            self.calc_length_parts()
+        return self.length_parts
+
+    def update_length_parts(self, term_ids, old_df):
+        # move the sums of every doc holding a term off its old df
+        old_log = np.log(np.maximum(old_df, 1))
+        new_log = self.log_df(term_ids)
+        changed = old_log != new_log
+        postings = [self.index.postings(term_id)
+                    for term_id in term_ids[changed]]
+        if postings:
+            lengths = [len(docs) for (docs, tfs) in postings]
+            docs = np.concatenate([docs for (docs, tfs) in postings])
+            squares = self.tf(np.concatenate([tfs for (d, tfs)
+                                              in postings])) ** 2
+            old = np.repeat(old_log[changed], lengths)
+            new = np.repeat(new_log[changed], lengths)
+            for i, changes in [(1, new - old), (2, new ** 2 - old ** 2)]:
+                self.length_parts[:, i] += np.bincount(
+                    docs, weights=squares * changes,
+                    minlength=len(self.length_parts))
+
+    def update_lengths(self, new_docs=None):
+        """Recompute doc lengths and divisors from the length sums.
+
+        Costs one pass over the docs, not the postings. Pruning bounds are
+        loosened by as much as any live doc's divisor shrank, and raised
+        for the terms of new_docs, before the new divisors are published,
+        so a query running alongside never sees bounds that are too low.
+        Merging segments tightens them again.
+        """
+        log_n = np.log(max(self.num_docs, 1))
+        parts = self.length_parts
+        squares = (log_n ** 2 * parts[:, 0] - 2 * log_n * parts[:, 1] +
+                   parts[:, 2])
+        # what is left of a doc of only zero idf terms is rounding
+        squares[squares <= 1e-12 * log_n ** 2 * parts[:, 0]] = 0
+        lengths = np.sqrt(squares)
+        divisors = self.divisor(lengths)
+
+        old = self.divisors
+        live = ~self.deleted & (old > 0) & (divisors > 0)
+        if new_docs is not None:
+            live[new_docs] = False
+        max_weights = self.max_weights
+        if live.any():
+            shrink = (divisors[live] / old[live]).min()
+            if shrink < 1:
+                max_weights = max_weights / shrink
+        if new_docs is not None:
+            max_weights = max_weights.copy()
+            rows, term_ids, tfs = self.forward_index().rows(new_docs)
+            np.maximum.at(max_weights, term_ids,
+                          self.tf(tfs) / divisors[new_docs[rows]])
+        self.max_weights = max_weights
+        self.divisors = divisors
+        self.doc_lengths = lengths
+
+    def set_collection_stats(self, df, num_docs):
+        """Weight terms by the doc frequencies and doc count of a larger
+        collection, such as every shard of a sharded index, so scores
+        match an index over all of it.
+
+        df holds a document frequency per term id of this index.
+        """
+        self.df = np.array(df, dtype=self.df.dtype)
+        self.num_docs = num_docs
+        self.update_idf()
+        lengths = self.calc_doc_lengths(self.index.all_segments(),
+                                        len(self.doc_lengths))
+        self.divisors = self.divisor(lengths)
+        self.doc_lengths = lengths
+        self.calc_length_parts()
+        self.calc_max_weights()
+
+    def update_idf(self):
+        # terms whose docs have all been deleted get no weight
+        with np.errstate(divide='ignore'):
+            self.idf = np.where(self.df > 0, np.log(
+                self.num_docs / np.maximum(self.df, 1).astype(np.float64)),
+                0.0)
+
+    def divisor(self, doc_lengths):
+        """What weights are divided by for docs of the given lengths."""
+        if self.pivot_params is not None:
+            slope, pivot_factor = self.pivot_params
+            return pivoted_lengths(doc_lengths, slope, pivot_factor)
+        if self.normalize:
+            return doc_lengths
+        return np.ones(len(doc_lengths))
+
+    def normalize_l(self):
+        self.divisors = self.divisor(self.doc_lengths)
 
     def pivot(self, slope, pivot_factor):
         # results from PivotFinder
         # DO NOT try to instantiate PivotFinder from within this class
         if self.normalize is False:
             raise Exception('Error, can only pivot whe nonrmalized.')
-        pivoted = {}
-        for word in self.weights.keys():
-            pivoted[word] = []
-            for pair in self.weights[word]:
-                doc_num = pair[0]
-                new_weight = pair[1] / (((1.0 - slope) * pivot_factor) + (
-                    slope * self.doc_lengths[doc_num]))
-                new = (doc_num, new_weight)
-                pivoted[word].append(new)
-        del self.normalized
-        gc.collect()
-        self.normalized = pivoted
+        # divide by the pivoted length instead, always starting from the
+        # raw weights so pivot can be applied again with new parameters
+        self.pivot_params = (slope, pivot_factor)
+        self.normalize_l()
+        self.calc_max_weights()
+
+    def weights_changed(self):
+        # drop everything derived from the current weights, including
+        # quantized weights, which are exact weights from now on
+        self.impact_scale = None
+        self.matrix = None
+        self.impacts = None
+        # anything still being built from the old weights is thrown away
+        self.generation += 1
+        if self.cache is not None:
+            self.cache.clear()
+
+    def calc_max_weights(self):
+        # called whenever the weights change
+        self.weights_changed()
+        self.max_weights = self.segment_max_weights()
+
+    def segment_max_weights(self):
+        # upper bounds on each term's tf / divisor, for pruning queries,
+        # kept without idf so they stay valid as idf changes, built apart
+        # from the ones queries may be reading
+        max_weights = np.zeros(len(self.idf))
+        divisors = self.divisors
+        for segment in self.index.all_segments():
+            terms = np.flatnonzero(segment.doc_freqs())
+            if len(terms):
+                maxes = np.maximum.reduceat(
+                    self.tf(segment.tfs) / divisors[segment.doc_ids],
+                    segment.offsets[terms])
+                max_weights[terms] = np.maximum(max_weights[terms], maxes)
+        return max_weights
+
+    def add_documents(self, paths_or_texts):
+        """Index new documents without rebuilding the index.
+
+        Takes file paths or (blog_id, text) pairs. Postings go into the
+        write buffer, and document frequencies, idf and the new docs'
+        lengths are updated straight away, so they can be queried at once.
+        Other docs' lengths move with idf, and only the postings of terms
+        whose df changed are read to update them. Returns the new doc ids.
+        """
+        with self.lock:
+            forward = self.forward_index()
+            new_docs = list()
+            new_postings = list()
+            for item in paths_or_texts:
+                if isinstance(item, tuple):
+                    blog_id, doc = item
+                else:
+                    blog_id, doc = file_blog_id(item), read_document(item)
+                self.blog_id_list.append(blog_id)
+                id_num = len(self.blog_id_list)
+                new_docs.append(id_num)
+                self.stats.count('docs_read')
+
+                # skip empty docs!
+                if not doc:
+                    self.blank_docs.append(id_num)
+                    forward.append(id_num, [], [])
+                    continue
+                self.num_docs += 1
+
+                term_freqs = list()
+                fds, term_positions = _index_document(
+                    doc, self.analyzer, self.biwords, self.english_only,
+                    self.positions, self.stats)
+                words = list()
+                for fd in fds:
+                    for word, freq in fd.items():
+                        term_freqs.append((self.index.add_term(word), freq))
+                        words.append(word)
+                if term_freqs:
+                    if term_positions is not None:
+                        term_positions = [term_positions[word]
+                                          for word in words]
+                    self.index.add_postings(id_num, term_freqs,
+                                            term_positions)
+                    new_postings.append((id_num, term_freqs))
+                forward.append(id_num,
+                               [term_id for (term_id, f) in term_freqs],
+                               [freq for (t, freq) in term_freqs])
+
+            self.grow()
+            if new_postings:
+                docs = np.array([id_num for (id_num, t) in new_postings])
+                rows, term_ids, tfs = forward.rows(docs)
+                # the new docs' sums start from the old df, and then move
+                # with those of every other doc holding their terms
+                parts = self.parts()
+                squares = self.tf(tfs) ** 2
+                log_df = self.log_df(term_ids)
+                for i, weights in enumerate([squares, squares * log_df,
+                                             squares * log_df ** 2]):
+                    parts[docs, i] = np.bincount(rows, weights=weights,
+                                                 minlength=len(docs))
+                term_ids, counts = np.unique(term_ids, return_counts=True)
+                old_df = self.df[term_ids].copy()
+                self.df[term_ids] += counts
+                self.update_idf()
+                self.update_length_parts(term_ids, old_df)
+                self.update_lengths(docs)
+            self.weights_changed()
+
+            if self.index.buffered_docs >= BUFFER_DOCS:
+                self.index.flush()
+                self.merge_segments(background=True)
+        return new_docs
+
+    def delete_documents(self, blog_ids):
+        """Remove documents by blog id, returning their doc ids.
+
+        Deleted docs are only marked, and skipped at query time. Their
+        terms are taken off the document frequencies straight away, and
+        their postings dropped once the segments holding them are merged.
+        """
+        with self.lock:
+            matches = self.blog_ids.index[
+                self.blog_ids['id'].isin(list(blog_ids))].values
+            self.grow()
+            blank = np.zeros(len(self.deleted), dtype=bool)
+            blank[self.blank_docs] = True
+            docs = matches[~self.deleted[matches] & ~blank[matches]]
+            if not len(docs):
+                return []
+
+            rows, term_ids, tfs = self.forward_index().rows(docs)
+            term_ids, counts = np.unique(term_ids, return_counts=True)
+            old_df = self.df[term_ids].copy()
+            # the sums must be taken at the old df, if not loaded
+            self.parts()
+            self.deleted[docs] = True
+            self.num_deleted += len(docs)
+            self.num_docs -= len(docs)
+            self.df[term_ids] -= counts
+            self.update_idf()
+            self.update_length_parts(term_ids, old_df)
+            self.update_lengths()
+            self.weights_changed()
+        return docs.tolist()
+
+    def grow(self):
+        # make room in the per term and per doc arrays, doubling so that
+        # adding docs one at a time stays cheap, and copy out of any
+        # read-only memory map
+        for name, size in [('df', len(self.index)),
+                           ('max_weights', len(self.index)),
+                           ('doc_lengths', len(self.blog_id_list) + 1),
+                           ('length_parts', len(self.blog_id_list) + 1),
+                           ('divisors', len(self.blog_id_list) + 1),
+                           ('deleted', len(self.blog_id_list) + 1)]:
+            values = getattr(self, name)
+            if values is None:
+                continue
+            if len(values) < size or not values.flags.writeable:
+                grown = np.zeros((max(size, 2 * len(values)),) +
+                                 values.shape[1:], dtype=values.dtype)
+                grown[:len(values)] = values
+                setattr(self, name, grown)
+
+    def merge_segments(self, background=False):
+        """Merge adjacent segments until there are at most MAX_SEGMENTS.
+
+        Merging drops the postings of deleted docs, and tightens the
+        pruning bounds that adding and deleting docs loosened. With
+        background, this runs in a thread while queries carry on against
+        the old segments.
+        """
+        if background:
+            if self.merger is None or not self.merger.is_alive():
+                self.merger = threading.Thread(target=self.merge_segments)
+                self.merger.daemon = True
+                self.merger.start()
+            return
+
+        while len(self.index.segments) > MAX_SEGMENTS:
+            segments = self.index.segments
+            sizes = [len(segments[i]) + len(segments[i + 1])
+                     for i in range(len(segments) - 1)]
+            i = sizes.index(min(sizes))
+            first, second = segments[i], segments[i + 1]
+            keep = ~self.deleted
+            merged = Segment.merge([first, second], len(self.index), keep)
+
+            with self.lock:
+                # segments may have been added while merging
+                self.grow()
+                segments = list(self.index.segments)
+                i = segments.index(first)
+                segments[i:i + 2] = [merged]
+                self.index.segments = segments
+                self.calc_max_weights()
+
+    def save(self, path, compress=False, impact_bits=None):
+        """Write the index to a single binary file at path.
+
+        Segments, the write buffer and deletions are merged into one
+        segment with a sorted vocabulary on the way out. compress stores
+        doc id d-gaps and tfs as variable-byte codes with block skips, and
+        impact_bits (8 or 16) also stores the current weights quantized,
+        which queries on the loaded index then score with. The forward
+        index is saved too, so processes loading the file share it.
+        """
+        with self.lock:
+            index, order = self.index.compacted(~self.deleted)
+            segment = index.segments[0]
+            arrays = {
+                'terms': index.terms,
+                'offsets': segment.offsets,
+                'df': self.df[order],
+                'doc_lengths': self.doc_lengths[:len(self.blog_id_list) + 1],
+                'divisors': self.divisors[:len(self.blog_id_list) + 1],
+                'length_parts': self.parts()[:len(self.blog_id_list) + 1],
+                'max_weights': self.max_weights[order],
+                'deleted': self.deleted[:len(self.blog_id_list) + 1],
+                'blank_docs': np.array(self.blank_docs, dtype=np.int32),
+                'blog_ids': np.array(self.blog_id_list, dtype=np.string_)
+            }
+            meta = {
+                'tokenization': self.tokenization,
+                'biwords': self.biwords,
+                'positions': self.positions,
+                'normalize': self.normalize,
+                'english_only': self.english_only,
+                'corpus_dir': self.corpus_dir,
+                'num_docs': self.num_docs,
+                'pivot': self.pivot_params
+            }
+            if self.positions:
+                arrays['positions'] = segment.positions
+            forward = ForwardIndex.from_segment(segment,
+                                                len(self.blog_id_list) + 1)
+            arrays.update({
+                'forward_offsets': forward.offsets,
+                'forward_term_ids': forward.term_ids,
+                'forward_tfs': forward.tfs
+            })
+            if compress or impact_bits:
+                weights = None
+                if impact_bits:
+                    weights = (self.tf(segment.tfs) *
+                               self.idf[order][segment.term_ids()] /
+                               self.divisors[segment.doc_ids])
+                segment = CompressedSegment.from_segment(segment, weights,
+                                                         impact_bits)
+                arrays.update({
+                    'block_last': segment.block_last,
+                    'block_starts': segment.block_starts,
+                    'postings': segment.data
+                })
+                if impact_bits:
+                    arrays['impacts'] = segment.impacts
+                    meta['impact_scale'] = segment.impact_scale
+            else:
+                arrays['doc_ids'] = segment.doc_ids
+                arrays['tfs'] = segment.tfs
+        write_arrays(path, arrays, meta)
+
+    @classmethod
+    def load(cls, path, use_mmap=True, cache_size=0, cache_bytes=None,
+             stats=None):
+        """Load an index written by save without touching the corpus.
+
+        The postings stay memory-mapped, so processes loading the same file
+        share the page-cached index rather than each holding a copy. Adding
+        or deleting documents copies only the small per term and per doc
+        arrays out of the map.
+        """
+        arrays, meta = read_arrays(path, use_mmap)
+        self = cls.__new__(cls)
+        self.stats = stats if stats is not None else Stats()
+        self.tokenization = dict((str(key), value) for (key, value)
+                                 in meta['tokenization'].items())
+        self.analyzer = Analyzer(**self.tokenization)
+        self.biwords = meta['biwords']
+        self.positions = meta.get('positions', False)
+        self.normalize = meta['normalize']
+        self.english_only = meta['english_only']
+        self.corpus_dir = meta['corpus_dir']
+        self.num_docs = meta['num_docs']
+        self.pivot_params = meta['pivot'] and tuple(meta['pivot'])
+
+        self.blog_id_list = arrays['blog_ids'].tolist()
+        self.blog_frame = None
+        self.blank_docs = arrays['blank_docs'].tolist()
+
+        self.impact_scale = None
+        if 'postings' in arrays:
+            segment = CompressedSegment(
+                arrays['offsets'], arrays['block_last'],
+                arrays['block_starts'], arrays['postings'],
+                arrays.get('impacts'), meta.get('impact_scale'),
+                arrays.get('positions'))
+            self.impact_scale = segment.impact_scale
+        else:
+            segment = Segment(arrays['offsets'], arrays['doc_ids'],
+                              arrays['tfs'], arrays.get('positions'))
+        self.index = InvertedIndex(arrays['terms'], [segment])
+        # files saved before df was stored hold only local frequencies
+        self.df = arrays.get('df', segment.doc_freqs())
+        self.update_idf()
+        self.doc_lengths = arrays['doc_lengths']
+        self.divisors = arrays['divisors']
+        self.max_weights = arrays['max_weights']
+        self.deleted = arrays['deleted']
+        self.num_deleted = int(self.deleted.sum())
+        # files saved without the length sums compute them when needed
+        self.length_parts = arrays.get('length_parts')
+        self.matrix = None
+        self.impacts = None
+        self.generation = 0
+        self.forward = None
+        if 'forward_offsets' in arrays:
+            self.forward = ForwardIndex(arrays['forward_offsets'],
+                                        arrays['forward_term_ids'],
+                                        arrays['forward_tfs'])
+        self.cache = None
+        if cache_size:
+            self.cache = ResultCache(cache_size, cache_bytes)
+        self.lock = threading.RLock()
+        self.merger = None
+        self.impact_builder = None
+        return self
@@ -0,0 +1,249 @@
+"""HTTP/JSON query service over an index written by SearchEngine.save.
+
+python server.py index.bin --port 8000 --workers 4
+
+GET  /search?q=...&k=10
+POST /batch   {"queries": ["...", ...], "k": 10}
+GET  /health
+GET  /stats
+"""
+import sys
+import json
+import time
+import argparse
+import threading
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from multiprocessing import Pool, TimeoutError
+
+from search import SearchEngine
+
+# seconds a request may wait for its worker
+TIMEOUT = 5.0
+
+# requests in flight before new ones are turned away
+MAX_QUEUE = 64
+
+MAX_K = 1000
+MAX_BATCH = 1000
+
+# the engine of a worker process
+_engine = None
+
+
+def _load(path, cache_size):
+    global _engine
+    _engine = SearchEngine.load(path, use_mmap=True, cache_size=cache_size)
+
+
+def _rows(results):
+    return [{'id': blog_id, 'doc': int(doc), 'score': float(score)}
+            for (doc, score, blog_id) in zip(
+                results.index, results['relevance'], results['id'])]
+
+
+def _run(func, args):
+    # errors come back as results, so the completion callback always runs
+    try:
+        return True, func(*args)
+    except Exception as error:
+        return False, '{}: {}'.format(type(error).__name__, error)
+
+
+def _search(query, k):
+    return _rows(_engine.query(query, k))
+
+
+def _search_batch(queries, k):
+    # one query at a time against the mapped postings, where query_batch
+    # would build a weight matrix private to each worker
+    return [_search(query, k) for query in queries]
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        params = urlparse.parse_qs(url.query)
+        if url.path == '/search':
+            if not params.get('q'):
+                return self.send_json(400, {'error': 'missing q'})
+            k = self.parse_k(params.get('k', [10])[0])
+            if k is not None:
+                self.dispatch(_search, (params['q'][0], k))
+        elif url.path == '/health':
+            self.send_json(200, self.server.health())
+        elif url.path == '/stats':
+            self.send_json(200, self.server.stats())
+        else:
+            self.send_json(404, {'error': 'not found'})
+
+    def do_POST(self):
+        if urlparse.urlparse(self.path).path != '/batch':
+            return self.send_json(404, {'error': 'not found'})
+        try:
+            length = int(self.headers.getheader('content-length') or 0)
+            body = json.loads(self.rfile.read(length))
+            queries = body['queries']
+        except (ValueError, KeyError, TypeError):
+            return self.send_json(400, {'error': 'expected a JSON object '
+                                        'with a list of queries'})
+        if (not isinstance(queries, list) or len(queries) > MAX_BATCH or
+                not all(isinstance(query, basestring) for query in queries)):
+            return self.send_json(400, {'error': 'queries must be a list '
+                                        'of at most {} strings'.format(
+                                            MAX_BATCH)})
+        k = self.parse_k(body.get('k', 10))
+        if k is not None:
+            self.dispatch(_search_batch, (queries, k))
+
+    def parse_k(self, k):
+        try:
+            k = int(k)
+        except (ValueError, TypeError):
+            k = 0
+        if 1 <= k <= MAX_K:
+            return k
+        self.send_json(400, {'error': 'k must be from 1 to {}'.format(MAX_K)})
+
+    def dispatch(self, func, args):
+        status, result = self.server.dispatch(func, args)
+        if status == 200:
+            self.send_json(200, {'results': result})
+        else:
+            self.send_json(status, {'error': result})
+
+    def send_json(self, status, obj):
+        body = json.dumps(obj)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class QueryServer(ThreadingMixIn, HTTPServer):
+    """Threaded HTTP front end handing queries to engine worker processes.
+
+    Every worker memory-maps the same saved index, so its postings are held
+    once in the page cache however many workers there are. With max_queue
+    requests in flight, new ones get 503, and requests whose worker takes
+    longer than timeout get 504. A timed out request stays in flight until
+    its worker is done with it.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, index_path, address=('127.0.0.1', 8000), workers=4,
+                 timeout=TIMEOUT, max_queue=MAX_QUEUE, cache_size=0,
+                 verbose=False):
+        # workers are forked before the socket is opened
+        self.pool = Pool(workers, _load, (index_path, cache_size))
+        HTTPServer.__init__(self, address, QueryHandler)
+        self.index_path = index_path
+        self.workers = workers
+        self.request_timeout = timeout
+        self.max_queue = max_queue
+        self.verbose = verbose
+        self.slots = threading.BoundedSemaphore(max_queue)
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.in_flight = 0
+        self.counts = {'served': 0, 'rejected': 0, 'timeouts': 0,
+                       'errors': 0}
+        self.seconds = 0.0
+
+    def dispatch(self, func, args):
+        """Run func(*args) in a worker, as (HTTP status, result or error)."""
+        if not self.slots.acquire(False):
+            self.count('rejected')
+            return 503, 'too many requests in flight'
+        start = time.time()
+        with self.lock:
+            self.in_flight += 1
+        try:
+            # the slot is held until the worker is done, even after a
+            # timeout, so max_queue also bounds the pool's backlog
+            pending = self.pool.apply_async(_run, (func, args),
+                                            callback=self.done)
+        except Exception:
+            self.done()
+            raise
+        try:
+            ok, result = pending.get(self.request_timeout)
+        except TimeoutError:
+            self.count('timeouts')
+            return 504, 'timed out after {}s'.format(self.request_timeout)
+        except Exception as error:
+            self.count('errors')
+            return 500, '{}: {}'.format(type(error).__name__, error)
+        if not ok:
+            self.count('errors')
+            return 500, result
+        self.count('served', time.time() - start)
+        return 200, result
+
+    def done(self, result=None):
+        # a task finished in its worker, successfully or not
+        with self.lock:
+            self.in_flight -= 1
+        self.slots.release()
+
+    def count(self, name, seconds=0.0):
+        with self.lock:
+            self.counts[name] += 1
+            self.seconds += seconds
+
+    def health(self):
+        return {'status': 'ok', 'workers': self.workers,
+                'in_flight': self.in_flight, 'max_queue': self.max_queue}
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counts, in_flight=self.in_flight)
+            served = self.counts['served']
+            stats['mean_ms'] = 1000 * self.seconds / served if served else 0
+        stats['uptime'] = time.time() - self.started
+        stats['index'] = self.index_path
+        return stats
+
+    def server_close(self):
+        HTTPServer.server_close(self)
+        self.pool.terminate()
+        self.pool.join()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('index', help='index file written by save')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--timeout', type=float, default=TIMEOUT)
+    parser.add_argument('--max-queue', type=int, default=MAX_QUEUE)
+    parser.add_argument('--cache-size', type=int, default=0,
+                        help='result cache entries per worker')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args(argv)
+
+    server = QueryServer(args.index, (args.host, args.port), args.workers,
+                         args.timeout, args.max_queue, args.cache_size,
+                         args.verbose)
+    print >> sys.stderr, 'Serving {} on {}:{}'.format(
+        args.index, args.host, server.server_address[1])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
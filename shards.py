@@ -0,0 +1,175 @@
+import os
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+
+from search import SearchEngine, top_k
+from index import read_arrays
+from sources import DirectorySource, PartSource
+
+SHARD_NAME = 'shard-{:04d}.bin'
+
+# the shard of a shard process
+_shard = None
+
+
+def _build_shard(args):
+    """Build and save one shard, returning its terms, dfs and doc count."""
+    path, source, parts, options = args
+    engine = SearchEngine(sample=False, source=PartSource(source, parts),
+                          **options)
+    engine.save(path)
+    return (np.array(engine.index.terms), engine.df[:len(engine.index)],
+            engine.num_docs)
+
+
+def _weight_shard(args):
+    """Reweight a saved shard by the collection's dfs and doc count."""
+    path, df, num_docs = args
+    engine = SearchEngine.load(path)
+    engine.set_collection_stats(df, num_docs)
+    engine.save(path)
+
+
+def _load_shard(path, cache_size):
+    global _shard
+    _shard = SearchEngine.load(path, cache_size=cache_size)
+
+
+def _top(results):
+    return (results['relevance'].values, np.asarray(results.index),
+            list(results['id']))
+
+
+def _shard_query(engine, raw_string, k, prune):
+    return _top(engine.query(raw_string, k, prune))
+
+
+def _shard_query_batch(engine, raw_strings, k):
+    return [_top(results) for results in engine.query_batch(raw_strings, k)]
+
+
+def _call(func, args):
+    return func(_shard, *args)
+
+
+class ShardedSearchEngine(object):
+    """A collection split by document into shards, queried as one index.
+
+    Each shard is a saved SearchEngine over a contiguous run of the
+    collection's parts, weighted by document frequencies and a doc count
+    summed over every shard, so its scores match a single index over the
+    whole collection. Queries fan out to the shards and their top k lists
+    are merged; doc ids are offset by the docs in earlier shards, which
+    makes them the doc ids of the single index too.
+
+    With processes each shard is served by its own process, otherwise all
+    shards are loaded here.
+    """
+
+    def __init__(self, paths, processes=True, cache_size=0):
+        self.paths = list(paths)
+        self.processes = processes
+        # doc id offset of each shard
+        sizes = [len(read_arrays(path)[0]['blog_ids'])
+                 for path in self.paths]
+        self.offsets = np.cumsum([0] + sizes[:-1])
+        self.pools = None
+        self.engines = None
+        if processes:
+            self.pools = [Pool(1, _load_shard, (path, cache_size))
+                          for path in self.paths]
+        else:
+            self.engines = [SearchEngine.load(path, cache_size=cache_size)
+                            for path in self.paths]
+
+    @classmethod
+    def build(cls, shard_dir, num_shards, source=None, corpus_dir='corpus/',
+              workers=None, processes=True, cache_size=0, **options):
+        """Split a source's parts into num_shards runs and index each.
+
+        Shards are built and reweighted in parallel, by workers processes
+        (one per shard by default), and saved in shard_dir. options are
+        passed to each shard's SearchEngine.
+        """
+        if source is None:
+            source = DirectorySource(corpus_dir)
+        if not os.path.isdir(shard_dir):
+            os.makedirs(shard_dir)
+        parts = source.parts()
+        size = -(-len(parts) // num_shards)
+        paths = [os.path.join(shard_dir, SHARD_NAME.format(i))
+                 for i in range(num_shards)]
+        options = dict(options, corpus_dir=corpus_dir)
+
+        pool = Pool(workers or num_shards)
+        try:
+            built = pool.map(_build_shard, [
+                (path, source, parts[i * size:(i + 1) * size], options)
+                for (i, path) in enumerate(paths)])
+
+            # sum each term's document frequency over the shards
+            terms, inverse = np.unique(np.concatenate(
+                [shard_terms for (shard_terms, df, num_docs) in built]),
+                return_inverse=True)
+            df = np.bincount(inverse, weights=np.concatenate(
+                [shard_df for (shard_terms, shard_df, num_docs) in built]),
+                minlength=len(terms)).astype(np.int64)
+            num_docs = sum(shard_docs for (t, d, shard_docs) in built)
+
+            bounds = np.cumsum([0] + [len(shard_terms) for
+                                      (shard_terms, d, n) in built])
+            pool.map(_weight_shard, [
+                (path, df[inverse[bounds[i]:bounds[i + 1]]], num_docs)
+                for (i, path) in enumerate(paths)])
+        finally:
+            pool.close()
+            pool.join()
+        return cls(paths, processes, cache_size)
+
+    @classmethod
+    def load(cls, shard_dir, processes=True, cache_size=0):
+        """Serve the shards built in shard_dir."""
+        paths = sorted(os.path.join(shard_dir, name)
+                       for name in os.listdir(shard_dir)
+                       if name.startswith('shard-') and
+                       name.endswith('.bin'))
+        return cls(paths, processes, cache_size)
+
+    def scatter(self, func, args):
+        """Run func(shard, *args) on every shard, in shard order."""
+        if self.processes:
+            pending = [pool.apply_async(_call, (func, args))
+                       for pool in self.pools]
+            return [result.get() for result in pending]
+        return [func(engine, *args) for engine in self.engines]
+
+    def gather(self, tops, k):
+        """Merge per shard (scores, docs, blog ids) into one top k."""
+        scores = np.concatenate([top[0] for top in tops])
+        docs = np.concatenate([top[1] + offset for (top, offset)
+                               in zip(tops, self.offsets)]).astype(np.int64)
+        blog_ids = dict(zip(docs.tolist(), [blog_id for top in tops
+                                            for blog_id in top[2]]))
+        docs, scores = top_k(docs, scores.astype(np.float64), k)
+        result_df = pd.DataFrame(scores, index=docs, columns=['relevance'])
+        result_df['id'] = [blog_ids[doc] for doc in docs.tolist()]
+        return result_df
+
+    def query(self, raw_string, k=10, prune=False):
+        """Return the k best scoring docs over all shards."""
+        return self.gather(self.scatter(_shard_query,
+                                        (raw_string, k, prune)), k)
+
+    def query_batch(self, raw_strings, k=10):
+        """query_batch on every shard, merged per query."""
+        shard_tops = self.scatter(_shard_query_batch, (raw_strings, k))
+        return [self.gather(tops, k) for tops in zip(*shard_tops)]
+
+    def close(self):
+        if self.pools is not None:
+            for pool in self.pools:
+                pool.close()
+                pool.join()
+            self.pools = None
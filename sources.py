@@ -0,0 +1,126 @@
+import os
+import io
+import re
+import gzip
+
+# read buffer for corpus files, large so bundles stream in few syscalls
+BUFFER_SIZE = 1 << 20
+
+DOCNO = re.compile(r'<DOCNO>\s*(\S+?)\s*</DOCNO>')
+
+
+def open_file(path):
+    """Open a corpus file for buffered reading, gunzipping .gz files."""
+    if path.endswith('.gz'):
+        return io.BufferedReader(gzip.open(path, 'rb'), BUFFER_SIZE)
+    return io.open(path, 'rb', buffering=BUFFER_SIZE)
+
+
+def file_blog_id(path):
+    """Blog id of a one document file, its name up to the first dot."""
+    return os.path.basename(path).split('.')[0]
+
+
+def read_document(path):
+    f = open_file(path)
+    doc = f.read()
+    f.close()
+    return doc
+
+
+class DirectorySource(object):
+    """Every file under corpus_dir is one document, optionally gzipped.
+
+    Sources are read in parts, here single files, which can be handed to
+    separate processes. read yields (blog_id, text) pairs lazily.
+    single_doc_parts says whether each part holds exactly one document, so
+    that a sample of parts is a sample of documents.
+    """
+
+    single_doc_parts = True
+
+    def __init__(self, corpus_dir='corpus/'):
+        self.corpus_dir = corpus_dir
+
+    def parts(self):
+        return [os.path.join(root, name)
+                for root, dirs, files in os.walk(
+                self.corpus_dir, topdown=True) for name in files]
+
+    def read(self, part):
+        yield file_blog_id(part), read_document(part)
+
+    def __iter__(self):
+        for part in self.parts():
+            for doc in self.read(part):
+                yield doc
+
+
+class TrecSource(DirectorySource):
+    """TREC bundle files holding many <DOC> records, optionally gzipped.
+
+    path is one bundle or a directory of them, as in the original Blogs06
+    distribution. A record's text is everything after its DOCHDR block,
+    or after the DOCNO line if it has none.
+    """
+
+    single_doc_parts = False
+
+    def __init__(self, path):
+        self.path = path
+
+    def parts(self):
+        if os.path.isdir(self.path):
+            return sorted(os.path.join(root, name)
+                          for root, dirs, files in os.walk(self.path)
+                          for name in files)
+        return [self.path]
+
+    def read(self, part):
+        f = open_file(part)
+        docno = None
+        lines = None
+        for line in f:
+            if line.startswith('<DOC>'):
+                docno = None
+                lines = list()
+            elif line.startswith('</DOC>'):
+                if docno is not None and lines is not None:
+                    yield docno, ''.join(lines)
+                docno = None
+                lines = None
+            elif lines is None:
+                continue
+            elif docno is None:
+                match = DOCNO.search(line)
+                if match:
+                    docno = match.group(1)
+            elif line.startswith('<DOCHDR>'):
+                # skip the http header block
+                for line in f:
+                    if line.startswith('</DOCHDR>'):
+                        break
+                lines = list()
+            else:
+                lines.append(line)
+        f.close()
+
+
+class PartSource(object):
+    """A fixed run of the parts of another source, e.g. one shard's."""
+
+    def __init__(self, source, parts):
+        self.source = source
+        self.part_list = list(parts)
+        self.single_doc_parts = getattr(source, 'single_doc_parts', False)
+
+    def parts(self):
+        return list(self.part_list)
+
+    def read(self, part):
+        return self.source.read(part)
+
+    def __iter__(self):
+        for part in self.part_list:
+            for doc in self.read(part):
+                yield doc
@@ -0,0 +1,176 @@
+import sys
+import time
+import pstats
+import cProfile
+import resource
+
+import pandas as pd
+
+# functions printed for each profiled stage
+PROFILE_LINES = 25
+
+_END = object()
+
+
+def peak_rss_mb():
+    # linux reports kilobytes
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+class _NullTimer(object):
+    # shared do-nothing context, all a disabled stage costs
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NULL_TIMER = _NullTimer()
+
+
+class _Timer(object):
+
+    def __init__(self, stats, stage):
+        self.stats = stats
+        self.stage = stage
+
+    def __enter__(self):
+        self.wall = time.time()
+        self.cpu = time.clock()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stats.add_time(self.stage, time.time() - self.wall,
+                            time.clock() - self.cpu)
+        return False
+
+
+class _Profile(object):
+
+    def __init__(self, stats, stage):
+        self.stats = stats
+        self.stage = stage
+
+    def __enter__(self):
+        self.stats.profiling_stage = self.stage
+        self.rss = peak_rss_mb()
+        self.profiler = cProfile.Profile()
+        self.profiler.enable()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profiler.disable()
+        self.stats.profiling_stage = None
+        stream = self.stats.stream or sys.stderr
+        print >> stream, 'Profile of {}, peak RSS grew {:.1f} MB:'.format(
+            self.stage, peak_rss_mb() - self.rss)
+        profile = pstats.Stats(self.profiler, stream=stream)
+        profile.sort_stats('cumulative').print_stats(self.stats.profile_lines)
+        self.stats.profiles[self.stage] = profile
+        return False
+
+
+class Stats(object):
+    """Wall and CPU time per stage, and counters, for tracing slow work.
+
+    Stages are timed with `with stats.timer(stage):` and events counted
+    with stats.count(name, n). Each hook is called as hook(kind, name,
+    value), with ('time', stage, (wall, cpu)) as a stage finishes and
+    ('count', name, n) on each count, e.g. to feed a metrics exporter.
+    Disabled stats hand out one shared no-op timer and ignore counts.
+
+    With profile, stats.profile(stage) runs the stage under cProfile and
+    prints its hot spots and the growth in peak RSS to stream (stderr by
+    default). The pstats are kept in profiles by stage.
+    """
+
+    def __init__(self, enabled=False, profile=False,
+                 profile_lines=PROFILE_LINES, stream=None):
+        self.enabled = enabled
+        self.profiling = profile
+        self.profile_lines = profile_lines
+        self.stream = stream
+        self.profiling_stage = None
+        self.profiles = {}
+        self.hooks = list()
+        self.reset()
+
+    def reset(self):
+        # stage: [calls, wall, cpu]
+        self.times = {}
+        self.counts = {}
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    def timer(self, stage):
+        if not self.enabled:
+            return NULL_TIMER
+        return _Timer(self, stage)
+
+    def timed(self, stage, items):
+        """Iterate items, timing the production of each under stage."""
+        if not self.enabled:
+            return items
+        return self._timed(stage, iter(items))
+
+    def _timed(self, stage, items):
+        # the last next, finding items exhausted, is neither timed nor
+        # counted
+        while True:
+            wall = time.time()
+            cpu = time.clock()
+            item = next(items, _END)
+            if item is _END:
+                return
+            self.add_time(stage, time.time() - wall, time.clock() - cpu)
+            yield item
+
+    def profile(self, stage):
+        # profiles don't nest, the outermost stage covers the rest
+        if not self.profiling or self.profiling_stage is not None:
+            return NULL_TIMER
+        return _Profile(self, stage)
+
+    def add_time(self, stage, wall, cpu, calls=1):
+        totals = self.times.get(stage)
+        if totals is None:
+            totals = self.times[stage] = [0, 0.0, 0.0]
+        totals[0] += calls
+        totals[1] += wall
+        totals[2] += cpu
+        for hook in self.hooks:
+            hook('time', stage, (wall, cpu))
+
+    def count(self, name, n=1):
+        if not self.enabled:
+            return
+        self.counts[name] = self.counts.get(name, 0) + n
+        for hook in self.hooks:
+            hook('count', name, n)
+
+    def merge(self, other):
+        """Add in the times and counts of another Stats, e.g. a worker's."""
+        for stage, (calls, wall, cpu) in sorted(other.times.items()):
+            self.add_time(stage, wall, cpu, calls)
+        for name, n in sorted(other.counts.items()):
+            self.count(name, n)
+
+    def report(self):
+        """Calls, wall and CPU seconds per stage, slowest first."""
+        report = pd.DataFrame([[stage] + totals for (stage, totals)
+                               in self.times.items()],
+                              columns=['stage', 'calls', 'wall', 'cpu'])
+        return report.set_index('stage').sort_values('wall',
+                                                     ascending=False)
+
+    def __getstate__(self):
+        # hooks and streams stay in the process that set them
+        state = dict(self.__dict__, hooks=list(), stream=None,
+                     profiles={})
+        return state
@@ -1,49 +1,151 @@
-from nltk.tokenize import RegexpTokenizer
+import re
+
 from nltk.corpus import stopwords as sw
 from nltk.stem.porter import PorterStemmer
 from nltk.stem.lancaster import LancasterStemmer
 from nltk.stem import SnowballStemmer
 from nltk import WordNetLemmatizer
 
+from cache import LRUCache
 
-def tokens(document, lowercase=True, tokenize='no_digits', 
-           stopwords=False, stemming=None, lemmatize=False):
-    """Tokenize a raw string based on passed tokenization options."""
-    raw_doc = unicode(document, errors='ignore')
-
-    # adjust case
-    if lowercase:
-        raw_doc = raw_doc.lower()
-
-    # tokenize according to specifications
-    if tokenize == 'symbols':
-        tokenizer = RegexpTokenizer(r'[\'\w\-]+')
-    if tokenize == 'no_symbols':
-        tokenizer = RegexpTokenizer(r'\w+')
-    if tokenize == 'no_digits':
-        tokenizer = RegexpTokenizer(r'[A-Za-z]+')
-    tokens = tokenizer.tokenize(raw_doc)
-
-    if not stopwords:
-        stop = sw.words('english')
-        tokens = [word for word in tokens if word not in stop]
-
-    if stemming and lemmatize:
-        print ('Error: can only choose one of stemming or lemmatize. '
-               'Choosing stemming')
-        lemmatize = False
-
-    if stemming:
+PATTERNS = {
+    'symbols': r'[\'\w\-]+',
+    'no_symbols': r'\w+',
+    'no_digits': r'[A-Za-z]+'
+}
+
+# same flags nltk's RegexpTokenizer compiles with
+FLAGS = re.UNICODE | re.MULTILINE | re.DOTALL
+
+# word -> stem memo entries kept per analyzer
+MEMO_SIZE = 100000
+
+_stopwords = None
+_analyzers = {}
+
+
+def english_stopwords():
+    """The nltk English stopwords as a frozenset, loaded once."""
+    global _stopwords
+    if _stopwords is None:
+        _stopwords = frozenset(sw.words('english'))
+    return _stopwords
+
+
+class Analyzer(object):
+    """Tokenization options compiled once for tokenizing many strings.
+
+    Holds the compiled pattern, the stopword set and a single stemmer or
+    lemmatizer, whose output is memoized per word in a bounded LRU cache.
+    """
+
+    def __init__(self, lowercase=True, tokenize='no_digits',
+                 stopwords=False, stemming=None, lemmatize=False,
+                 memo_size=MEMO_SIZE):
+        if stemming and lemmatize:
+            print ('Error: can only choose one of stemming or lemmatize. '
+                   'Choosing stemming')
+            lemmatize = False
+
+        self.lowercase = lowercase
+        self.pattern = re.compile(PATTERNS[tokenize], FLAGS)
+        self.stop = frozenset() if stopwords else english_stopwords()
+
+        self.stem = None
         if stemming == 'porter':
-            stemmer = PorterStemmer()
+            self.stem = PorterStemmer().stem
         if stemming == 'lancaster':
-            stemmer = LancasterStemmer()
+            self.stem = LancasterStemmer().stem
         if stemming == 'snowball':
-            stemmer = SnowballStemmer('english')
-        tokens = [stemmer.stem(word) for word in tokens]
+            self.stem = SnowballStemmer('english').stem
+        if lemmatize:
+            self.stem = WordNetLemmatizer().lemmatize
+        self.memo = LRUCache(memo_size)
+
+    def text(self, document):
+        """A raw string as unicode, lowercased if set."""
+        if isinstance(document, unicode):
+            raw_doc = document
+        else:
+            raw_doc = unicode(document, errors='ignore')
+
+        # adjust case
+        if self.lowercase:
+            raw_doc = raw_doc.lower()
+        return raw_doc
+
+    def filter(self, words):
+        """Drop stopwords from and stem a sequence of words, lazily."""
+        stop = self.stop
+        stem = self.stem
+        memo = self.memo
+        for word in words:
+            if word in stop:
+                continue
+            if stem is not None:
+                stemmed = memo.get(word)
+                if stemmed is None:
+                    stemmed = stem(word)
+                    memo.put(word, stemmed)
+                word = stemmed
+            yield word
+
+    def iter_tokens(self, document):
+        """Iterate over the tokens of a raw string.
+
+        With nothing to drop or stem this is the pattern's list of
+        matches, found without a python loop per token.
+        """
+        words = self.pattern.findall(self.text(document))
+        if not self.stop and self.stem is None:
+            return words
+        return self.filter(words)
+
+    def iter_positions(self, document, all_tokens=None):
+        """Generate (position, token) pairs of a raw string.
 
-    if lemmatize:
-        wnl = WordNetLemmatizer()
-        tokens = [wnl.lemmatize(word) for word in tokens]
+        Positions count every word, dropped stopwords included, so phrases
+        keep their gaps. all_tokens, if a list, also collects every token
+        with stopwords kept, in the same pass.
+        """
+        words = self.pattern.findall(self.text(document))
+        stop = self.stop
+        stem = self.stem
+        memo = self.memo
+        for position, word in enumerate(words):
+            dropped = word in stop
+            if dropped and all_tokens is None:
+                continue
+            if stem is not None:
+                stemmed = memo.get(word)
+                if stemmed is None:
+                    stemmed = stem(word)
+                    memo.put(word, stemmed)
+                word = stemmed
+            if all_tokens is not None:
+                all_tokens.append(word)
+            if not dropped:
+                yield position, word
 
-    return tokens
+    def tokens(self, document):
+        """Tokenize a raw string into a list."""
+        words = self.iter_tokens(document)
+        if isinstance(words, list):
+            return words
+        return list(words)
+
+
+def analyzer(**options):
+    """Shared Analyzer for a set of tokenization options."""
+    key = tuple(sorted(options.items()))
+    if key not in _analyzers:
+        _analyzers[key] = Analyzer(**options)
+    return _analyzers[key]
+
+
+def tokens(document, lowercase=True, tokenize='no_digits',
+           stopwords=False, stemming=None, lemmatize=False):
+    """Tokenize a raw string based on passed tokenization options."""
+    return analyzer(lowercase=lowercase, tokenize=tokenize,
+                    stopwords=stopwords, stemming=stemming,
+                    lemmatize=lemmatize).tokens(document)